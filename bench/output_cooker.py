@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the telnet output cooker (per write overhead)
+
+Runs _cook() with REPLACEMENTS populated like main() does on a single
+character echo and on output chunks (with and without replaced keys)
+against the former chained str.replace loop and reports the best of 5
+runs.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import hontel
+
+from thirdparty.telnetsrv.telnetsrvlib import IAC
+
+CHUNKS = (("echo", "l"), ("400B listing", "drwxr-xr-x  2 root root 4096 Jan  1 00:00 bin\n" * 9), ("1KB uname -a", "Linux prodigy 4.4.0 #1 SMP Ubuntu x86_64 x86_64 x86_64 GNU/Linux\n" * 16), ("3.5KB listing", "drwxr-xr-x  2 root root 4096 Jan  1 00:00 bin\n" * 80), ("3.5KB uname", "Linux prodigy 4.4.0 #1 SMP x86_64 GNU/Linux\n" * 80), ("3.5KB uname -a", "Linux prodigy 4.4.0 #1 SMP Ubuntu x86_64 x86_64 x86_64 GNU/Linux\n" * 55), ("64KB listing", "drwxr-xr-x  2 root root 4096 Jan  1 00:00 bin\n" * 1500))
+RUNS = 5
+
+def _populate():
+    hontel.REPLACEMENTS[hontel.HOSTNAME] = hontel.FAKE_HOSTNAME
+    hontel.REPLACEMENTS["Ubuntu"] = "Debian"
+
+    for arch in ("i386", "i686", "x86_64 x86_64 x86_64", "x86_64 x86_64", "x86_64", "amd64"):
+        hontel.REPLACEMENTS[arch] = hontel.FAKE_ARCHITECTURE
+
+    hontel.REPLACEMENTS["BusyBox v1.22.1 (Ubuntu 1:1.22.0-15ubuntu1)"] = hontel.BUSYBOX_FAKE_BANNER
+    hontel.REPLACEMENTS["BusyBox v1.22.1"] = "BusyBox v1.18.4"
+
+def _chained(text):
+    for key, value in hontel.REPLACEMENTS.items():
+        text = text.replace(key, value)
+    return text.replace(IAC, IAC + IAC).replace("\n", "\r\n")
+
+def _best(function, chunk):
+    count = max(10, 1000000 / (len(chunk) * 10))
+    best = None
+    for _ in xrange(RUNS):
+        start = time.time()
+        for _ in xrange(count):
+            function(chunk)
+        elapsed = time.time() - start
+
+        best = min(best, elapsed) if best is not None else elapsed
+
+    return 1e6 * best / count
+
+def main():
+    _populate()
+
+    for name, chunk in CHUNKS:
+        print "%s (%d bytes), chained %.1f us, _cook %.1f us per write (best of %d)" % (name, len(chunk), _best(_chained, chunk), _best(hontel._cook, chunk), RUNS)
+
+if __name__ == "__main__":
+    main()
@@ -3,49 +3,1637 @@
 # Copyright (c) 2015 Miroslav Stampar (@stamparm)
 # See the file 'LICENSE' for copying permission
 
+USE_GEVENT = False  # set to True to serve all sessions from a single-threaded (gevent) event loop instead of thread-per-connection
+
+if USE_GEVENT:
+    from gevent import monkey
+    monkey.patch_all()
+
+import collections
+import errno
 import fcntl
+import fnmatch
 import hashlib
+import httplib
+import math
+import multiprocessing
 import os
+import pipes
 import posixpath
+import pty
+import Queue
 import re
-import shutil
+import resource
+import select
 import signal
 import socket
+import sqlite3
 import SocketServer
 import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import termios
 import threading
 import time
-import urllib
 import urlparse
 
 sys.dont_write_bytecode = True
 
-from thirdparty.telnetsrv.threaded import TelnetHandler, command
+if USE_GEVENT:
+    from gevent.server import StreamServer
+    from thirdparty.telnetsrv.green import TelnetHandler, command
+else:
+    from thirdparty.telnetsrv.threaded import TelnetHandler, command
+
+from thirdparty.telnetsrv.telnetsrvlib import IAC
 
 AUTH_USERNAME = "root"
 AUTH_PASSWORD = "123456"
 MAX_AUTH_ATTEMPTS = 3
+NEGOTIATION_TIMEOUT = 0.5  # maximum time (in seconds) to wait for client's answers to the initial telnet options
 TELNET_ISSUE = "\nTELNET session now in ESTABLISHED state\n"
 WELCOME = None
 LOG_PATH = "/var/log/%s.log" % os.path.split(__file__)[-1].split('.')[0]
 SAMPLES_DIR = "/var/log/%s/" % os.path.split(__file__)[-1].split('.')[0]
+SAMPLE_REVALIDATE = 3600  # time (in seconds) for which sample retrieved from the same URL is reused (i.e. not downloaded again)
+SAMPLE_STORE = None
 READ_SIZE = 1024
+DOWNLOAD_WORKERS = 4  # number of background workers retrieving samples
+DOWNLOAD_HOST_LIMIT = 2  # maximum number of concurrent downloads from the same host
+DOWNLOAD_QUEUE_SIZE = 1024  # maximum number of pending downloads (dropped afterwards)
+DOWNLOAD_TIMEOUT = 30  # connect/read timeout (in seconds) of sample downloads
+DOWNLOAD_DURATION_LIMIT = 300  # maximum duration (in seconds) of a sample download (aborted afterwards)
+DOWNLOAD_SIZE_LIMIT = 10 * 1024 * 1024  # maximum size (in bytes) of a sample (aborted afterwards)
+DOWNLOADER = None
+PREFETCH_SIBLINGS = True  # set to False to disable speculative retrieval of other architectures' binaries from the dropper servers
+PREFETCH_ARCHITECTURES = ("arm", "arm5n", "arm6", "arm7", "i486", "i686", "m68k", "mips", "mpsl", "ppc", "sh4", "spc", "sparc", "x86")  # initial set of architecture tokens (extended by learning from the sample index)
+PREFETCH_QUEUE_SIZE = 4096  # maximum number of pending speculative downloads (dropped afterwards)
+PREFETCHER = None
+TRIAGE_WORKERS = 2  # number of background processes triaging captured samples (ELF header, strings and family markers) into the index (0 to disable)
+TRIAGE_FAMILIES = {"Mirai": ("MIRAI", "ECCHI", "IHCCE", "dvrHelper"), "Wopbot": ("WOPBOT",)}  # markers (i.e. byte strings) of known families searched for inside the samples
+TRIAGE_STRINGS_LIMIT = 4096  # maximum number of (printable) strings kept per sample
+SIMILARITY_HASHES = 64  # number of (one permutation) MinHash values per sample (power of 2) used for finding its nearest variants
+SIMILARITY_BANDS = 16  # number of LSH bands the MinHash values are split into (i.e. samples sharing any band are compared)
+MINHASH_EMPTY = 0xffffffffffffffff
+MINHASH_BLOCK_SIZE = 64 * 1024
+ELF_MACHINES = {2: "SPARC", 3: "x86", 4: "m68k", 8: "MIPS", 18: "SPARC32+", 20: "PowerPC", 21: "PowerPC64", 40: "ARM", 42: "SuperH", 43: "SPARCv9", 62: "x86-64", 183: "AArch64", 243: "RISC-V"}
+ELF_TYPES = {1: "relocatable", 2: "executable", 3: "shared", 4: "core"}
+ELF_PT_DYNAMIC, ELF_PT_INTERP, ELF_SHT_SYMTAB = 2, 3, 2
+LOGIN_TIMEOUT = 60  # maximum time (in seconds) for client to authenticate (disconnected afterwards)
+IDLE_TIMEOUT = 300  # maximum time (in seconds) without client's input (disconnected afterwards)
+SESSION_TIMEOUT = 3600  # maximum duration (in seconds) of a session (disconnected afterwards)
+TIMER_WHEEL = None
+COMMAND_TIMEOUT = 10  # maximum time (in seconds) for attacker's command to complete (killed afterwards)
+COMMAND_OUTPUT_LIMIT = 1024 * 1024  # maximum output (in bytes) relayed per command (killed afterwards)
+SESSION_OUTPUT_LIMIT = 16 * 1024 * 1024  # maximum output (in bytes) relayed per session (closed afterwards)
 CHECK_CHROOT = False
-THREAD_DATA = threading.local()
+LOG_DATA = {}
+STATS_INTERVAL = 3600  # interval (in seconds) of logging the operational statistics of the whole server (e.g. shell pool's and response cache's hit rates) (0 to disable)
 LOG_FILE_PERMISSIONS = stat.S_IREAD | stat.S_IWRITE | stat.S_IRGRP | stat.S_IROTH
 LOG_HANDLE_FLAGS = os.O_APPEND | os.O_CREAT | os.O_WRONLY
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 USE_BUSYBOX = True
 LISTEN_ADDRESS = "0.0.0.0"
 LISTEN_PORT = 23
+LISTEN_BACKLOG = 1024
 HOSTNAME = socket.gethostname()
 REPLACEMENTS = {}
+COOKER_DATA = {}
 BUSYBOX_FAKE_BANNER = "BusyBox v1.18.4 (2012-04-17 18:58:31 CST)"
 FAKE_HOSTNAME = "prodigy"
 FAKE_ARCHITECTURE = "MIPS"
 RUN_ATTACKERS_COMMANDS = True  # set to False to prevent execution of attacker's commands
+SHELL_POOL_SIZE = 10  # number of pre-spawned shells kept ready for new sessions (0 to disable)
+SHELL_POOL = None
+USE_PTY = False  # set to True to run shells on a pseudo-terminal (output of all sessions relayed by a single I/O reactor)
+PTY_OUTPUT_BACKLOG = 256 * 1024  # maximum output (in bytes) held back for a client not reading it (closed afterwards)
+PTY_INPUT_BACKLOG = 64 * 1024  # maximum input (in bytes) held back for a shell not reading it (closed afterwards)
+REACTOR = None
+SHELL_ERROR_REGEX = None
+EMULATE_SHELL = False  # set to True to answer common bot commands by an in-process (emulated) busybox shell (real shell is spawned only for unknown commands)
+FILESYSTEM_SNAPSHOT = None  # path to a (chroot) directory loaded once as the shared read-only base image of the emulated filesystem
+FILESYSTEM_DATA = {}
+EMULATED_FILESYSTEM_LIMIT = 1024 * 1024  # maximum total size (in bytes) of data written by a session to the emulated filesystem ('No space left on device' afterwards)
+RESPONSE_CACHE_SIZE = 256  # maximum number of cached responses to deterministic commands (0 to disable)
+RESPONSE_CACHE_TTL = 3600  # time (in seconds) after which cached response is invalidated
+RESPONSE_CACHE_BYTES = 4 * 1024 * 1024  # maximum total size (in bytes) of cached responses
+RESPONSE_CACHE_REGEX = r"\A(?:(?:(?:/bin/)?busybox(?: (?:[A-Z]+|cat /proc/(?:cpuinfo|mounts|version)|cat /bin/(?:busybox|echo|sh)|uname(?: -[a-z]+)?))?|cat /proc/(?:cpuinfo|mounts|version)|cat /bin/(?:busybox|echo|sh)|uname(?: -[a-z]+)?)(?: ?(?:;|&&) ?|\Z))+\Z"  # (normalized) commands allowed to be cached
+RESPONSE_CACHE = None
+BUSYBOX_APPLETS = ("arp", "ash", "awk", "basename", "cat", "chmod", "chown", "clear", "cp", "cut", "date", "dd", "df", "dirname", "dmesg", "du", "echo", "egrep", "env", "expr", "false", "fgrep", "find", "free", "ftpget", "ftpput", "grep", "gunzip", "gzip", "halt", "head", "hostname", "id", "ifconfig", "init", "kill", "killall", "ln", "login", "ls", "md5sum", "mkdir", "mknod", "mount", "mv", "nc", "netstat", "nslookup", "passwd", "ping", "poweroff", "ps", "pwd", "reboot", "rm", "rmdir", "route", "sed", "sh", "sleep", "sort", "su", "sync", "tail", "tar", "tee", "telnet", "telnetd", "test", "tftp", "top", "touch", "tr", "true", "umount", "uname", "uptime", "vi", "wc", "wget", "which", "whoami", "xargs", "yes")
+
+def _cook(text):
+    """
+    Applies REPLACEMENTS (longest match first) and telnet output cooking (IAC doubling, LF -> CRLF)
+    """
+
+    cooker = COOKER_DATA.get("cooker")
+
+    if cooker is None or cooker[0] != REPLACEMENTS:
+        replacements = dict(REPLACEMENTS)
+        cooker = COOKER_DATA["cooker"] = (replacements, sorted((_ for _ in replacements.items() if _[0]), key=lambda _: len(_[0]), reverse=True))
+
+    # Note: C str.replace (guarded by the even cheaper 'in') is faster than any single-pass re on real shell output
+    for key, value in cooker[1]:
+        if key in text:
+            text = text.replace(key, value)
+
+    return text.replace(IAC, IAC + IAC).replace("\n", "\r\n")
+
+FETCH_COMMANDS_REGEX = re.compile(r"(?i)wget|curl|tftp|ftpget")
+FETCH_SPLIT_REGEX = re.compile(r"&&|\|\||[;&|\n`]")
+FETCH_TOKEN_REGEX = re.compile(r"""\d?>&\d|\d?>>?\s*('[^']*'|"[^"]*"|[^\s<>'"]+)?|('[^']*'|"[^"]*"|[^\s<>'"]+)""")
+FETCH_OPTIONS = {"wget": ("-O", "-o", "-P", "-U", "-T", "-t", "-Y", "-e", "--header", "--output-document", "--user-agent"), "curl": ("-o", "-u", "-H", "-A", "-e", "-x", "-m", "-d", "--output", "--user", "--header", "--user-agent", "--connect-timeout", "--max-time")}
+
+def _fetches(command):
+    """
+    Returns fetch intents (protocol, URL, target file) found in the whole command chain (in a single pass)
+    """
+
+    retval = []
+
+    if FETCH_COMMANDS_REGEX.search(command):
+        # Note: only commands mentioning the fetch utilities get tokenized
+        for segment in FETCH_SPLIT_REGEX.split(command):
+            if FETCH_COMMANDS_REGEX.search(segment):
+                words, redirection = [], None
+                for target, word in FETCH_TOKEN_REGEX.findall(segment):
+                    if word:
+                        words.append(word.strip("'\""))
+                    elif target:
+                        redirection = target.strip("'\"")
+                try:
+                    fetch = _fetch(words, redirection)
+                except ValueError:  # Note: malformed URL (e.g. 'http://[::1')
+                    fetch = None
+                if fetch:
+                    retval.append(fetch)
+
+    return retval
+
+def _fetch(words, redirection):
+    """
+    Returns fetch intent (protocol, URL, target file) of a single (tokenized) command
+    """
+
+    while words and posixpath.basename(words[0]) == "busybox":
+        words = words[1:]
+
+    name = posixpath.basename(words[0]).lower() if words else None
+    args = words[1:]
+    options, positional = {}, []
+
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith("--") and '=' in arg:
+            options[arg.split('=')[0]] = arg.split('=', 1)[1]
+        elif arg in FETCH_OPTIONS.get(name, ("-l", "-r", "-c", "-u", "-p", "-P")) and i + 1 < len(args):
+            options[arg] = args[i + 1]
+            i += 1
+        elif name == "wget" and arg.startswith("-O") and len(arg) > 2:
+            options["-O"] = arg[2:]
+        elif name == "tftp" and re.match(r"-[gp]*[lr]\Z", arg) and i + 1 < len(args):
+            options[arg[-2:]] = args[i + 1]
+            i += 1
+        elif arg.startswith('-'):
+            options[arg] = None
+        else:
+            positional.append(arg)
+        i += 1
+
+    if name in ("wget", "curl") and positional:
+        url = positional[0] if "://" in positional[0] else "http://%s" % positional[0]
+        if name == "wget":
+            target = options.get("-O", options.get("--output-document")) or posixpath.basename(urlparse.urlsplit(url).path) or "index.html"
+        else:
+            target = options.get("-o", options.get("--output")) or ("-O" in options and posixpath.basename(urlparse.urlsplit(url).path)) or "-"
+        if target == '-' and redirection:
+            target = redirection
+        return (url.split("://")[0].lower(), url, target)
+
+    elif name == "tftp" and positional:
+        remote = options.get("-r")
+        if not remote and options.get("-c") == "get" and len(positional) > 1:
+            remote = positional.pop(1)
+        if remote:
+            url = "tftp://%s%s/%s" % (positional[0], ":%s" % positional[1] if len(positional) > 1 else "", remote.lstrip('/'))
+            return ("tftp", url, options.get("-l") or posixpath.basename(remote))
+
+    elif name == "ftpget" and len(positional) > 1:
+        credentials = "%s%s@" % (options["-u"], ":%s" % options["-p"] if options.get("-p") else "") if options.get("-u") else ""
+        url = "ftp://%s%s%s/%s" % (credentials, positional[0], ":%s" % options["-P"] if options.get("-P") else "", positional[-1].lstrip('/'))
+        return ("ftp", url, positional[1])
+
+def _spawn_shell():
+    if USE_PTY:
+        master, slave = pty.openpty()
+
+        # Note: LF -> CRLF is done by the telnet output cooker
+        attributes = termios.tcgetattr(slave)
+        attributes[1] &= ~termios.ONLCR
+        termios.tcsetattr(slave, termios.TCSANOW, attributes)
+
+        def _preexec():
+            os.setsid()
+            fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+        process = subprocess.Popen(SHELL.split(), stdin=slave, stdout=slave, stderr=slave, close_fds=True, preexec_fn=_preexec, env=dict(os.environ, PS1=HoneyTelnetHandler.PROMPT, TERM=HoneyTelnetHandler.TERM))
+        os.close(slave)
+        process.master = master
+
+        flags = fcntl.fcntl(master, fcntl.F_GETFL)
+        fcntl.fcntl(master, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    else:
+        process = subprocess.Popen(SHELL.split(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True, preexec_fn=os.setsid)
+        process.master = None
+
+        flags = fcntl.fcntl(process.stdout, fcntl.F_GETFL)
+        fcntl.fcntl(process.stdout, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    return process
+
+def _kill_shell(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+    if process.master is not None:
+        try:
+            os.close(process.master)
+        except OSError:
+            pass
+        process.master = None
+
+    try:
+        process.wait()
+    except OSError:
+        pass
+
+class ShellPool(object):
+    """
+    Pool of pre-spawned shells (taking process creation out of the session's critical path)
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.ready = Queue.Queue()
+        self.refill = threading.Event()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.spawned = 0
+        self.spawn_time = 0.0
+
+        thread = threading.Thread(target=self._supervise)
+        thread.daemon = True
+        thread.start()
+
+    def _spawn(self):
+        start = time.time()
+        process = _spawn_shell()
+        with self.lock:
+            self.spawned += 1
+            self.spawn_time += time.time() - start
+        return process
+
+    def _supervise(self):
+        while True:
+            while self.ready.qsize() < self.size:
+                try:
+                    self.ready.put(self._spawn())
+                except OSError:
+                    break
+            self.refill.wait(1.0)
+            self.refill.clear()
+
+    def get(self):
+        """
+        Returns a ready shell (spawning one on the spot if the pool is empty)
+        """
+
+        while True:
+            try:
+                process = self.ready.get_nowait()
+            except Queue.Empty:
+                break
+            else:
+                self.refill.set()
+                if process.poll() is None:
+                    with self.lock:
+                        self.hits += 1
+                    return process
+                _kill_shell(process)
+
+        with self.lock:
+            self.misses += 1
+        return self._spawn()
+
+    def release(self, process, used):
+        """
+        Recycles a shell not used by the session (otherwise it gets discarded)
+        """
+
+        if not used and process.poll() is None and self.ready.qsize() < self.size:
+            self.ready.put(process)
+        else:
+            _kill_shell(process)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return "hits: %d/%d (%.1f%%), spawn: %.1fms avg" % (self.hits, total, 100.0 * self.hits / total if total else 0.0, 1000.0 * self.spawn_time / self.spawned if self.spawned else 0.0)
+
+class ResponseCache(object):
+    """
+    LRU cache of (cooked) responses to deterministic commands (serving them without touching the shell)
+    """
+
+    def __init__(self, size, ttl, regex, capacity):
+        self.size = size
+        self.ttl = ttl
+        self.regex = re.compile(regex)
+        self.capacity = capacity
+        self.bytes = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, command):
+        """
+        Returns the cache key of the (normalized) command or None if it is not cacheable
+        """
+
+        command = " ".join(command.split())
+        if self.regex.match(command):
+            return (command, FAKE_HOSTNAME, FAKE_ARCHITECTURE, BUSYBOX_FAKE_BANNER)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+    def put(self, key, response):
+        # Note: single response can't take more than a fraction of the whole cache
+        if len(response) > self.capacity / 16:
+            return
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= len(entry[1])
+            self.entries[key] = (time.time(), response)
+            self.bytes += len(response)
+            while len(self.entries) > self.size or self.bytes > self.capacity:
+                self.bytes -= len(self.entries.popitem(last=False)[1][1])
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return "hits: %d/%d (%.1f%%), entries: %d (%d bytes)" % (self.hits, total, 100.0 * self.hits / total if total else 0.0, len(self.entries), self.bytes)
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel (single thread firing the deadlines of all sessions)
+    """
+
+    def __init__(self, slots=512, resolution=1.0):
+        self.slots = [[] for _ in xrange(slots)]
+        self.resolution = resolution
+        self.position = 0
+        self.lock = threading.Lock()
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def schedule(self, delay, callback, *args):
+        """
+        Calls callback(*args) after (at least) delay seconds (returns timer for cancel())
+        """
+
+        ticks = int(math.ceil(delay / self.resolution)) + 1  # Note: current tick is already (partially) gone
+        with self.lock:
+            timer = [(ticks - 1) // len(self.slots), callback, args]
+            self.slots[(self.position + ticks) % len(self.slots)].append(timer)
+        return timer
+
+    def cancel(self, timer):
+        # Note: lazy removal (i.e. dropped once its slot comes around)
+        if timer:
+            timer[1] = None
+
+    def _run(self):
+        next_tick = time.time()
+
+        while True:
+            next_tick += self.resolution
+            time.sleep(max(0, next_tick - time.time()))
+
+            with self.lock:
+                self.position = (self.position + 1) % len(self.slots)
+                slot = self.slots[self.position]
+                expired = [_ for _ in slot if _[0] <= 0 and _[1]]
+                self.slots[self.position] = [_ for _ in slot if _[0] > 0 and _[1]]
+                for timer in self.slots[self.position]:
+                    timer[0] -= 1
+
+            for _, callback, args in expired:
+                try:
+                    callback(*args)
+                except:
+                    pass
+
+class SampleWriter(object):
+    """
+    Streams the sample into a temporary file inside the store while computing its digests (i.e. in a single pass)
+    """
+
+    def __init__(self):
+        handle, self.filename = tempfile.mkstemp(dir=SAMPLES_DIR, prefix=".sample_")
+        self.file = os.fdopen(handle, "wb")
+        self.digests = {"md5": hashlib.md5(), "sha1": hashlib.sha1(), "sha256": hashlib.sha256()}
+        self.size = 0
+        self.magic = ""
+
+    def write(self, data):
+        for digest in self.digests.values():
+            digest.update(data)
+        if len(self.magic) < 16:
+            self.magic += data[:16 - len(self.magic)]
+        self.size += len(data)
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+class SampleStore(object):
+    """
+    Content-addressed store of samples (SAMPLES_DIR/<sha256[:2]>/<sha256[2:4]>/<sha256>) with persistent index
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS samples (sha256 TEXT PRIMARY KEY, md5 TEXT, sha1 TEXT, size INTEGER, magic TEXT, name TEXT, first_seen REAL, last_seen REAL);
+            CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, sha256 TEXT, first_seen REAL, last_seen REAL, last_fetched REAL);
+            CREATE TABLE IF NOT EXISTS sources (sha256 TEXT, ip TEXT, first_seen REAL, last_seen REAL, PRIMARY KEY (sha256, ip));
+            CREATE TABLE IF NOT EXISTS triage (sha256 TEXT PRIMARY KEY, format TEXT, bits INTEGER, endianness TEXT, machine TEXT, type TEXT, linking TEXT, stripped INTEGER, packed INTEGER, family TEXT, markers TEXT, strings TEXT, triaged REAL, minhash TEXT, variant TEXT, similarity REAL);
+            CREATE TABLE IF NOT EXISTS bands (band INTEGER, hash TEXT, sha256 TEXT, PRIMARY KEY (band, hash, sha256));
+            CREATE INDEX IF NOT EXISTS bands_sha256 ON bands (sha256);
+        """)
+
+    def path(self, sha256):
+        return os.path.join(SAMPLES_DIR, sha256[:2], sha256[2:4], sha256)
+
+    def lookup(self, url):
+        """
+        Returns sha256 of the sample retrieved from url within the last SAMPLE_REVALIDATE seconds (None otherwise)
+        """
+
+        with self.lock:
+            row = self.db.execute("SELECT sha256 FROM urls WHERE url=? AND last_fetched>?", (url, time.time() - SAMPLE_REVALIDATE)).fetchone()
+
+        if row and os.path.exists(self.path(row[0])):
+            return row[0]
+
+    def store(self, writer, name, url=None):
+        """
+        Atomically moves the written sample into the store and returns its sha256
+        """
+
+        writer.close()
+        sha256 = writer.digests["sha256"].hexdigest()
+
+        destination = self.path(sha256)
+        if os.path.exists(destination):
+            os.remove(writer.filename)
+        else:
+            if not os.path.isdir(os.path.dirname(destination)):
+                try:
+                    os.makedirs(os.path.dirname(destination))
+                except OSError:
+                    pass
+            os.chmod(writer.filename, stat.S_IREAD | stat.S_IWRITE | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(writer.filename, destination)
+
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO samples (sha256, md5, sha1, size, magic, name, first_seen, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (sha256, writer.digests["md5"].hexdigest(), writer.digests["sha1"].hexdigest(), writer.size, writer.magic.encode("hex"), name, now, now))
+            self.db.execute("UPDATE samples SET last_seen=? WHERE sha256=?", (now, sha256))
+            if url:
+                self.db.execute("INSERT OR IGNORE INTO urls VALUES (?, ?, ?, ?, ?)", (url, sha256, now, now, now))
+                self.db.execute("UPDATE urls SET sha256=?, last_seen=?, last_fetched=? WHERE url=?", (sha256, now, now, url))
+
+        return sha256
+
+    def known(self, url):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM urls WHERE url=?", (url,)).fetchone() is not None
+
+    def urls(self, since=0):
+        with self.lock:
+            return self.db.execute("SELECT url, last_seen FROM urls WHERE last_seen>? ORDER BY last_seen", (since,)).fetchall()
+
+    def seen(self, sha256, ip, url=None):
+        """
+        Records that the sample has been dropped by the given source
+        """
+
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO sources VALUES (?, ?, ?, ?)", (sha256, ip, now, now))
+            self.db.execute("UPDATE sources SET last_seen=? WHERE sha256=? AND ip=?", (now, sha256, ip))
+            self.db.execute("UPDATE samples SET last_seen=? WHERE sha256=?", (now, sha256))
+            if url:
+                self.db.execute("UPDATE urls SET last_seen=? WHERE url=?", (now, url))
+
+def _triage(path):
+    """
+    Returns properties of a given sample (ELF header, strings and matched family markers)
+    """
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    result = {"format": None, "bits": None, "endianness": None, "machine": None, "type": None, "linking": None, "stripped": None}
+
+    if data[:4] == "\x7fELF" and len(data) > 6 and data[4] in "\x01\x02" and data[5] in "\x01\x02":
+        bits, endianness = (32, 64)[ord(data[4]) - 1], "<>"[ord(data[5]) - 1]
+        result.update(format="ELF", bits=bits, endianness={'<': "little", '>': "big"}[endianness])
+
+        try:
+            e_type, e_machine, _, _, e_phoff, e_shoff, _, _, e_phentsize, e_phnum, e_shentsize, e_shnum, _ = struct.unpack_from(endianness + ("HHIIIIIHHHHHH" if bits == 32 else "HHIQQQIHHHHHH"), data, 16)
+            result.update(type=ELF_TYPES.get(e_type, str(e_type)), machine=ELF_MACHINES.get(e_machine, str(e_machine)))
+
+            # Note: p_type and sh_type are at the same offsets in both 32-bit and 64-bit headers
+            segments = set(struct.unpack_from(endianness + 'I', data, e_phoff + i * e_phentsize)[0] for i in xrange(e_phnum))
+            sections = set(struct.unpack_from(endianness + 'I', data, e_shoff + i * e_shentsize + 4)[0] for i in xrange(e_shnum))
+            result.update(linking="dynamic" if segments & set((ELF_PT_DYNAMIC, ELF_PT_INTERP)) else "static", stripped=ELF_SHT_SYMTAB not in sections)
+        except struct.error:
+            pass  # Note: truncated (or deliberately malformed) headers
+
+    result["packed"] = "UPX!" in data
+    result["strings"] = re.findall(r"[\x20-\x7e]{4,}", data)[:TRIAGE_STRINGS_LIMIT]
+    result["markers"] = sorted(_ for markers in TRIAGE_FAMILIES.values() for _ in markers if _ in data)
+    result["family"] = ','.join(sorted(family for family, markers in TRIAGE_FAMILIES.items() if any(_ in data for _ in markers))) or None
+    result["minhash"] = _minhash(data)
+
+    return result
+
+def _minhash(data):
+    """
+    Returns one permutation MinHash (i.e. minimum hash value per bucket) of sample's unique byte 8-grams
+    """
+
+    signature = [MINHASH_EMPTY] * SIMILARITY_HASHES
+    shift = 64 - int(math.log(SIMILARITY_HASHES, 2))
+
+    # Note: shingles are streamed block by block (i.e. bounded memory) as duplicates can't change the minimums anyway
+    for start in xrange(0, len(data), MINHASH_BLOCK_SIZE):
+        block = data[start:start + MINHASH_BLOCK_SIZE + 7]
+        shingles = set()
+        for offset in xrange(min(8, len(block))):
+            shingles.update(struct.unpack_from("<%dQ" % min(MINHASH_BLOCK_SIZE / 8, (len(block) - offset) / 8), block, offset))
+
+        for value in shingles:
+            value = ((value ^ (value >> 29)) * 0x9e3779b97f4a7c15) & 0xffffffffffffffff
+            if value < signature[value >> shift]:
+                signature[value >> shift] = value
+
+    return signature
+
+def _bands(signature):
+    """
+    Returns LSH band hashes of a given MinHash (None for bands without any value)
+    """
+
+    size = SIMILARITY_HASHES / SIMILARITY_BANDS
+    return [hashlib.md5(struct.pack("<%dQ" % size, *signature[i:i + size])).hexdigest()[:16] if any(_ != MINHASH_EMPTY for _ in signature[i:i + size]) else None for i in xrange(0, SIMILARITY_HASHES, size)]
+
+def _similarity(first, second):
+    """
+    Returns estimated (Jaccard) similarity of two MinHashes
+    """
+
+    buckets = [(a, b) for a, b in zip(first, second) if a != MINHASH_EMPTY or b != MINHASH_EMPTY]
+    return float(sum(a == b for a, b in buckets)) / len(buckets) if buckets else 0.0
+
+def _variants(db, sha256, limit=10):
+    """
+    Returns nearest variants of a given (triaged) sample as (similarity, sha256) pairs (only samples sharing an LSH band are compared)
+    """
+
+    row = db.execute("SELECT minhash FROM triage WHERE sha256=?", (sha256,)).fetchone()
+    if not row or not row[0]:
+        return []
+
+    signature = struct.unpack("<%dQ" % SIMILARITY_HASHES, row[0].decode("hex"))
+    candidates = db.execute("SELECT DISTINCT triage.sha256, triage.minhash FROM bands AS a JOIN bands AS b ON a.band=b.band AND a.hash=b.hash JOIN triage ON b.sha256=triage.sha256 WHERE a.sha256=? AND b.sha256!=?", (sha256, sha256)).fetchall()
+
+    return sorted(((_similarity(signature, struct.unpack("<%dQ" % SIMILARITY_HASHES, minhash.decode("hex"))), candidate) for candidate, minhash in candidates if minhash and len(minhash) == SIMILARITY_HASHES * 16), reverse=True)[:limit]
+
+def _triage_worker(index, workers, path):
+    """
+    Background process triaging (its share of) samples as they appear inside the index (including the backlog)
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    parent = os.getppid()
+    db = sqlite3.connect(path, timeout=60)
+    last = 0
+
+    while os.getppid() == parent:
+        rows = db.execute("SELECT samples.rowid, samples.sha256 FROM samples LEFT JOIN triage ON samples.sha256=triage.sha256 WHERE samples.rowid>? AND samples.rowid%?=? AND triage.sha256 IS NULL ORDER BY samples.rowid LIMIT 256", (last, workers, index)).fetchall()
+
+        for last, sha256 in rows:
+            try:
+                result = _triage(SAMPLE_STORE.path(sha256))
+            except (IOError, OSError):
+                continue
+
+            with db:
+                db.execute("INSERT OR REPLACE INTO triage (sha256, format, bits, endianness, machine, type, linking, stripped, packed, family, markers, strings, triaged, minhash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (sha256, result["format"], result["bits"], result["endianness"], result["machine"], result["type"], result["linking"], result["stripped"], result["packed"], result["family"], ','.join(result["markers"]) or None, '\n'.join(result["strings"]), time.time(), struct.pack("<%dQ" % SIMILARITY_HASHES, *result["minhash"]).encode("hex")))
+                db.execute("DELETE FROM bands WHERE sha256=?", (sha256,))
+                db.executemany("INSERT OR IGNORE INTO bands VALUES (?, ?, ?)", ((band, hash_, sha256) for band, hash_ in enumerate(_bands(result["minhash"])) if hash_))
+
+            # Note: bands are committed beforehand so that concurrently triaged variants find (at least) each other one way
+            variants = _variants(db, sha256, None)
+            if variants:
+                with db:
+                    db.execute("UPDATE triage SET variant=?, similarity=? WHERE sha256=?", (variants[0][1], variants[0][0], sha256))
+                    db.executemany("UPDATE triage SET variant=?, similarity=? WHERE sha256=? AND (similarity IS NULL OR similarity<?)", ((sha256, similarity, candidate, similarity) for similarity, candidate in variants))
+
+        if not rows:
+            time.sleep(1)
+
+class DownloadManager(object):
+    """
+    Bounded pool of background workers retrieving samples (sessions only enqueue URLs)
+    """
+
+    def __init__(self, workers, host_limit, queue_size):
+        self.queue = Queue.Queue(queue_size)
+        self.queue_size = queue_size
+        self.queued = 0  # Note: URLs waiting for a worker (in queue or deferred by the host limit)
+        self.host_limit = host_limit
+        self.hosts = {}  # Note: host -> [active downloads, deferred URLs]
+        self.pending = {}  # Note: URL -> callbacks (i.e. concurrent requests for the same URL are downloaded once)
+        self.lock = threading.Lock()
+        self.idle = threading.Event()  # Note: set while there are no pending downloads
+        self.idle.set()
+
+        for _ in xrange(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def enqueue(self, url, callback):
+        """
+        Schedules retrieval of url into the sample store (callback(url, sha256, error) is called from the worker)
+        """
+
+        with self.lock:
+            if url in self.pending:
+                self.pending[url].append(callback)
+                return True
+
+            # Note: deferred URLs count against the queue size too (i.e. a single host can't park unbounded number of them)
+            if self.queued >= self.queue_size:
+                return False
+
+            self.queue.put_nowait(url)
+            self.queued += 1
+            self.pending[url] = [callback]
+            self.idle.clear()
+            return True
+
+    def _work(self):
+        while True:
+            url = self.queue.get()
+            host = urlparse.urlsplit(url).netloc.lower()
+
+            with self.lock:
+                entry = self.hosts.setdefault(host, [0, collections.deque()])
+                if entry[0] >= self.host_limit:
+                    # Note: picked up by the worker finishing one of the host's active downloads
+                    entry[1].append(url)
+                    continue
+                entry[0] += 1
+                self.queued -= 1
+
+            while url:
+                self._download(url)
+
+                with self.lock:
+                    url = entry[1].popleft() if entry[1] else None
+                    if url:
+                        self.queued -= 1
+                    else:
+                        entry[0] -= 1
+                        if not entry[0]:
+                            del self.hosts[host]
+
+    def _download(self, url):
+        sha256 = None
+
+        try:
+            writer = SampleWriter()
+            error = self._retrieve(url, writer) or self._sniff(writer)
+            if error:
+                writer.discard()
+            else:
+                sha256 = SAMPLE_STORE.store(writer, posixpath.basename(urlparse.urlsplit(url).path), url)
+        except Exception, ex:
+            error = str(ex) or type(ex).__name__
+
+        with self.lock:
+            callbacks = self.pending.pop(url, [])
+            if not self.pending:
+                self.idle.set()
+
+        for callback in callbacks:
+            try:
+                callback(url, sha256, error)
+            except:
+                pass
+
+    def _retrieve(self, url, writer):
+        """
+        Streams url into the sample writer (returns error if any)
+        """
+
+        state = {"connection": None, "sockets": [], "aborted": False}
+        error = None
+
+        # Note: socket timeouts alone don't stop the (trickling) tarpits
+        timer = TIMER_WHEEL.schedule(DOWNLOAD_DURATION_LIMIT, self._abort, state)
+
+        try:
+            for _ in xrange(5):
+                parts = urlparse.urlsplit(url)
+                state["connection"] = (httplib.HTTPSConnection if parts.scheme == "https" else httplib.HTTPConnection)(parts.netloc, timeout=DOWNLOAD_TIMEOUT)
+                state["connection"].connect()
+                state["sockets"].append(state["connection"].sock)
+                if state["aborted"]:
+                    raise socket.timeout
+                state["connection"].request("GET", urlparse.urlunsplit(("", "", parts.path or "/", parts.query, "")), headers={"User-Agent": "Wget"})
+                response = state["connection"].getresponse()
+
+                # Note: connection hands over its socket to the response when server closes the connection
+                state["sockets"].append(getattr(response.fp, "_sock", None))
+                if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+                    url = urlparse.urljoin(url, response.getheader("Location"))
+                    state["connection"].close()
+                else:
+                    break
+
+            if response.status != 200:
+                error = "HTTP %d" % response.status
+            elif int(response.getheader("Content-Length") or 0) > DOWNLOAD_SIZE_LIMIT:
+                error = "size limit (%d bytes)" % DOWNLOAD_SIZE_LIMIT
+
+            while not error:
+                data = response.read(READ_SIZE * 16)
+                if not data:
+                    break
+                if writer.size + len(data) > DOWNLOAD_SIZE_LIMIT:
+                    error = "size limit (%d bytes)" % DOWNLOAD_SIZE_LIMIT
+                else:
+                    writer.write(data)
+
+            if state["aborted"]:
+                raise socket.timeout
+        except Exception, ex:
+            error = "duration limit (%ds)" % DOWNLOAD_DURATION_LIMIT if state["aborted"] else (str(ex) or type(ex).__name__)
+        finally:
+            TIMER_WHEEL.cancel(timer)
+            if state["connection"]:
+                state["connection"].close()
+
+        return error or (None if writer.size else "empty response")
+
+    def _sniff(self, writer):
+        """
+        Returns error if the retrieved content is not a sample (e.g. catch-all HTML page of the web server)
+        """
+
+        if re.match(r"(?i)\s*<(?:!doctype|html|head|body|\?xml)", writer.magic):
+            return "not a sample (HTML)"
+
+    def _abort(self, state):
+        state["aborted"] = True
+        for sock in state["sockets"]:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+
+class SiblingPrefetcher(DownloadManager):
+    """
+    Speculative (low priority) retrieval of other architectures' binaries from the dropper servers
+    """
+
+    TOKEN_REGEX = re.compile(r"[^./_-]+")
+    GROUP_TTL = 7 * 24 * 3600  # Note: filenames not seen for a week are forgotten
+    MAX_GROUPS = 4096
+    MAX_ARCHITECTURES = 32  # Note: tokens are learned from attacker's URLs, i.e. each of them is one more request per capture
+    MAX_CANDIDATES = 1024
+    LEARN_HOSTS = 3  # Note: token is learned only once seen next to a known architecture on that many distinct hosts
+    MAX_SIBLINGS = 16  # Note: upper bound of speculative requests (to the attacker's chosen host) per capture
+    MAX_CONNECTIONS = 8
+    CONNECTION_IDLE = 15  # Note: idle keep-alive connections are closed afterwards
+
+    def __init__(self, architectures, queue_size):
+        self.initial = set(architectures)
+        self.architectures = set(architectures)
+        self.groups = collections.OrderedDict()  # Note: (filename prefix, filename suffix) -> [variable tokens, last seen] (least recently seen first)
+        self.candidates = collections.OrderedDict()  # Note: token -> distinct hosts it has been seen on (least recently seen first)
+        self.tried = set()
+        self.connections = collections.OrderedDict()  # Note: (scheme, host) -> idle keep-alive connection (least recently used first)
+        DownloadManager.__init__(self, 1, 1, queue_size)
+
+        for url, last_seen in SAMPLE_STORE.urls(time.time() - self.GROUP_TTL):
+            self._learn(url, last_seen)
+
+    def _learn(self, url, now=None):
+        """
+        Learns architecture tokens from filenames differing only in a single token (e.g. mirai.arm7 next to mirai.x86)
+        """
+
+        now = now or time.time()
+        index = url.rfind('/') + 1
+        host = urlparse.urlsplit(url).netloc.lower()
+        with self.lock:
+            for match in self.TOKEN_REGEX.finditer(url, index):
+                key = (url[:match.start()], url[match.end():])
+                entry = self.groups.pop(key, None) or [set(), now]
+                if len(entry[0]) < self.MAX_ARCHITECTURES:
+                    entry[0].add(match.group(0))
+                entry[1] = now
+                self.groups[key] = entry
+                if len(entry[0]) > 1 and entry[0] & self.architectures:
+                    for token in entry[0] - self.architectures:
+                        if len(token) > 8 or len(self.architectures) >= self.MAX_ARCHITECTURES:
+                            continue
+                        hosts = self.candidates.pop(token, None) or set()
+                        hosts.add(host)
+                        if len(hosts) >= self.LEARN_HOSTS:
+                            self.architectures.add(token)
+                        else:
+                            self.candidates[token] = hosts
+
+            while len(self.candidates) > self.MAX_CANDIDATES:
+                self.candidates.popitem(last=False)
+
+            while self.groups and (len(self.groups) > self.MAX_GROUPS or self.groups.itervalues().next()[1] < now - self.GROUP_TTL):
+                self.groups.popitem(last=False)
+
+    def siblings(self, url, callback):
+        """
+        Schedules retrieval of url's siblings for known architectures (initial ones first, at most MAX_SIBLINGS)
+        """
+
+        if '?' in url:
+            return
+
+        self._learn(url)
+
+        index = url.rfind('/') + 1
+        with self.lock:
+            match = next((_ for _ in reversed(list(self.TOKEN_REGEX.finditer(url, index))) if _.group(0) in self.architectures), None)
+            if not match:
+                return
+            candidates = [url[:match.start()] + _ + url[match.end():] for _ in sorted(self.architectures, key=lambda _: (_ not in self.initial, _)) if _ != match.group(0)][:self.MAX_SIBLINGS]
+            if len(self.tried) > 65536:
+                self.tried.clear()
+            candidates = [_ for _ in candidates if _ not in self.tried]
+            self.tried.update(candidates)
+
+        for candidate in candidates:
+            if not SAMPLE_STORE.known(candidate):
+                self.enqueue(candidate, callback)
+
+    def _download(self, url):
+        # Note: regular downloads take precedence
+        DOWNLOADER.idle.wait()
+
+        DownloadManager._download(self, url)
+
+    def _sniff(self, writer):
+        # Note: speculatively retrieved siblings are expected to be binaries (i.e. not e.g. catch-all pages of the web server)
+        if not writer.magic.startswith("\x7fELF"):
+            return "not an ELF binary"
+
+    def _checkin(self, key, connection):
+        """
+        Puts the idle keep-alive connection back into the (LRU) pool
+        """
+
+        with self.lock:
+            self.connections[key] = connection
+            expired = [self.connections.popitem(last=False)[1] for _ in xrange(len(self.connections) - self.MAX_CONNECTIONS)]
+
+        TIMER_WHEEL.schedule(self.CONNECTION_IDLE, self._expire, key, connection)
+
+        for connection in expired:
+            connection.close()
+
+    def _expire(self, key, connection):
+        with self.lock:
+            if self.connections.get(key) is not connection:
+                return
+            del self.connections[key]
+
+        connection.close()
+
+    def _retrieve(self, url, writer):
+        """
+        Streams url into the sample writer over the pooled (keep-alive) connection to its host (returns error if any)
+        """
+
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        state = {"connection": None, "sockets": [], "aborted": False}
+        error = None
+        reusable = False
+
+        timer = TIMER_WHEEL.schedule(DOWNLOAD_DURATION_LIMIT, self._abort, state)
+
+        try:
+            for attempt in xrange(2):
+                with self.lock:
+                    state["connection"] = self.connections.pop(key, None)
+                if state["connection"] is None:
+                    state["connection"] = (httplib.HTTPSConnection if parts.scheme == "https" else httplib.HTTPConnection)(parts.netloc, timeout=DOWNLOAD_TIMEOUT)
+                    state["connection"].connect()
+                state["sockets"] = [state["connection"].sock]
+
+                try:
+                    state["connection"].request("GET", urlparse.urlunsplit(("", "", parts.path or "/", parts.query, "")), headers={"User-Agent": "Wget", "Connection": "keep-alive"})
+                    response = state["connection"].getresponse()
+                    break
+                except (httplib.HTTPException, socket.error):
+                    # Note: pooled connection closed by the server in the meantime
+                    state["connection"].close()
+                    if attempt or state["aborted"]:
+                        raise
+
+            state["sockets"].append(getattr(response.fp, "_sock", None))
+            if int(response.getheader("Content-Length") or 0) > DOWNLOAD_SIZE_LIMIT:
+                error = "size limit (%d bytes)" % DOWNLOAD_SIZE_LIMIT
+            elif response.status != 200:
+                error = "HTTP %d" % response.status
+                response.read(DOWNLOAD_SIZE_LIMIT)
+            else:
+                while True:
+                    data = response.read(READ_SIZE * 16)
+                    if not data:
+                        break
+                    if writer.size + len(data) > DOWNLOAD_SIZE_LIMIT:
+                        error = "size limit (%d bytes)" % DOWNLOAD_SIZE_LIMIT
+                        break
+                    writer.write(data)
+
+            if state["aborted"]:
+                raise socket.timeout
+
+            # Note: connection can be reused only if the whole response has been consumed
+            reusable = response.isclosed() and not response.will_close
+        except Exception, ex:
+            error = "duration limit (%ds)" % DOWNLOAD_DURATION_LIMIT if state["aborted"] else (str(ex) or type(ex).__name__)
+        finally:
+            TIMER_WHEEL.cancel(timer)
+            if reusable:
+                self._checkin(key, state["connection"])
+            elif state["connection"]:
+                state["connection"].close()
+
+        return error or (None if writer.size else "empty response")
+
+class Reactor(object):
+    """
+    Single I/O loop relaying the output of all pseudo-terminal shells to their sessions
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.writers = {}  # Note: descriptor -> callback (waiting for the descriptor to become writable)
+        if hasattr(select, "epoll"):
+            self.poller, self.scale = select.epoll(), 1.0
+        else:  # Note: e.g. under gevent
+            self.poller, self.scale = select.poll(), 1000.0
+
+        thread = threading.Thread(target=self._loop)
+        thread.daemon = True
+        thread.start()
+
+    def register(self, fd, handler):
+        self.handlers[fd] = handler
+        self.poller.register(fd, select.POLLIN)
+
+    def writable(self, fd, callback):
+        """
+        Calls callback() once the descriptor becomes writable (i.e. the reactor itself never blocks on clients or shells)
+        """
+
+        if fd not in self.writers:
+            self.writers[fd] = callback
+            if fd in self.handlers:
+                self.poller.modify(fd, select.POLLIN | select.POLLOUT)
+            else:
+                self.poller.register(fd, select.POLLOUT)
+
+    def unregister(self, fd):
+        if (self.handlers.pop(fd, None), self.writers.pop(fd, None)) != (None, None):
+            try:
+                self.poller.unregister(fd)
+            except (IOError, OSError, KeyError, ValueError):
+                pass
+
+    def _loop(self):
+        while True:
+            try:
+                events = self.poller.poll(1.0 * self.scale)
+            except (IOError, OSError, select.error):
+                continue
+
+            for fd, event in events:
+                callback = self.writers.get(fd)
+                if callback is not None and (event & select.POLLOUT or fd not in self.handlers):
+                    if fd in self.handlers:
+                        del self.writers[fd]
+                        self.poller.modify(fd, select.POLLIN)
+                    else:
+                        self.unregister(fd)
+                    try:
+                        callback()
+                    except Exception:
+                        pass
+
+                handler = self.handlers.get(fd)
+                if handler is None or not event & ~select.POLLOUT:
+                    continue
+
+                try:
+                    data = os.read(fd, READ_SIZE)
+                except OSError:  # Note: EIO once the shell has exited
+                    data = ""
+
+                try:
+                    if data:
+                        handler._ptyOutput(data)
+                    else:
+                        self.unregister(fd)
+                        handler._ptyClosed()
+                except Exception:
+                    self.unregister(fd)
+
+def _fake_elf():
+    """
+    Returns the (minimal) ELF header of a binary built for FAKE_ARCHITECTURE (e.g. for 'cat /bin/echo' probes)
+    """
+
+    machine, endianness = {"ARM": (40, "<"), "M68K": (4, ">"), "MIPSEL": (8, "<"), "PPC": (20, ">"), "POWERPC": (20, ">"), "SH4": (42, "<"), "SPARC": (2, ">"), "X86": (3, "<"), "I386": (3, "<"), "I686": (3, "<")}.get(FAKE_ARCHITECTURE.upper(), (8, ">"))
+    header = "\x7fELF\x01%s\x01" % ("\x01" if endianness == "<" else "\x02") + "\x00" * 9
+    header += struct.pack("%sHHIIIIIHHHHHH" % endianness, 2, machine, 1, 0x400190, 52, 0, 0, 52, 32, 0, 40, 0, 0)
+    return header + "\x00" * 76
+
+def _load_filesystem():
+    """
+    Loads the shared (read-only) base image of the emulated filesystem (optionally from FILESYSTEM_SNAPSHOT)
+    """
+
+    DIRECTORY = VirtualFilesystem.DIRECTORY
+    image, sources, links = {"/": DIRECTORY}, {}, {}
+
+    def _resolve(current, host):
+        for _ in xrange(8):
+            if not os.path.islink(host):
+                break
+            current = posixpath.normpath(posixpath.join(posixpath.dirname(current), os.readlink(host)))
+            host = os.path.join(root, current.lstrip('/'))
+        return current, host
+
+    if FILESYSTEM_SNAPSHOT:
+        root = os.path.abspath(FILESYSTEM_SNAPSHOT)
+        for dirpath, dirnames, filenames in os.walk(root):
+            directory = posixpath.normpath(posixpath.join("/", os.path.relpath(dirpath, root)))
+            for name in dirnames + filenames:
+                path = posixpath.join(directory, name)
+                target, host = _resolve(path, os.path.join(dirpath, name))
+                if os.path.isdir(host):
+                    image[path] = DIRECTORY
+                    if target != path:
+                        links[path] = target
+                elif os.path.isfile(host):
+                    # Note: content is read (on demand) from the snapshot
+                    image[path] = None
+                    sources[path] = host
+                else:
+                    image[path] = ""
+
+        # Note: content of symlinked directories (e.g. /bin -> usr/bin)
+        for path, target in links.items():
+            for key in [_ for _ in image if _.startswith(target + '/')]:
+                image[path + key[len(target):]] = image[key]
+                if key in sources:
+                    sources[path + key[len(target):]] = sources[key]
+
+    for path in ("/bin", "/dev", "/etc", "/proc", "/root", "/sbin", "/tmp", "/usr", "/usr/bin", "/usr/sbin", "/var", "/var/run"):
+        image.setdefault(path, DIRECTORY)
+
+    image["/dev/null"] = ""
+    image["/proc/mounts"] = "rootfs / rootfs rw 0 0\n/dev/root / squashfs ro,relatime 0 0\nproc /proc proc rw,relatime 0 0\nsysfs /sys sysfs rw,relatime 0 0\ntmpfs /dev tmpfs rw,relatime 0 0\ndevpts /dev/pts devpts rw,relatime,mode=600 0 0\ntmpfs /tmp tmpfs rw,relatime 0 0\ntmpfs /var tmpfs rw,relatime 0 0\n"
+
+    # Note: binaries have to match the FAKE_ARCHITECTURE (e.g. 'cat /bin/echo' probes)
+    for path in ("/bin/busybox", "/bin/echo", "/bin/sh"):
+        image[path] = _fake_elf()
+        sources.pop(path, None)
+
+    tree = {}
+    for path in image:
+        if path != "/":
+            tree.setdefault(posixpath.dirname(path), set()).add(posixpath.basename(path))
+
+    FILESYSTEM_DATA.update({"image": image, "sources": sources, "tree": tree})
+
+class VirtualFilesystem(object):
+    """
+    Per-session copy-on-write overlay over the shared (read-only) base image
+    """
+
+    DIRECTORY = object()
+
+    def __init__(self):
+        self.overlay = {}  # Note: path -> content (string or list of appended chunks), DIRECTORY (opaque) or None (whiteout)
+        self.dirty = set()
+        self.written = 0
+
+    def lookup(self, path):
+        """
+        Returns the content of the path, DIRECTORY or None if it doesn't exist (raises KeyError if unknown without a snapshot)
+        """
+
+        current = path
+        while True:
+            if current in self.overlay:
+                if current == path:
+                    content = self.overlay[current]
+                    return "".join(content) if isinstance(content, list) else content
+                return None
+            elif posixpath.dirname(current) == current:
+                break
+            current = posixpath.dirname(current)
+
+        image = FILESYSTEM_DATA["image"]
+        if path in image:
+            if image[path] is None:
+                with open(FILESYSTEM_DATA["sources"][path], "rb") as f:
+                    return f.read()
+            return image[path]
+        elif FILESYSTEM_SNAPSHOT:
+            return None
+        else:
+            raise KeyError(path)
+
+    def exists(self, path):
+        try:
+            return self.lookup(path) is not None
+        except KeyError:
+            return False
+
+    def write(self, path, data, append=False, dirty=True):
+        """
+        Writes (or appends) the data to the path (raises IOError if it can't be created)
+        """
+
+        content = self.overlay.get(path)
+
+        if not isinstance(content, list):
+            try:
+                content = self.lookup(path)
+            except KeyError:
+                content = None
+
+        if content is self.DIRECTORY:
+            raise IOError(errno.EISDIR, os.strerror(errno.EISDIR))
+        elif self.written + len(data) > EMULATED_FILESYSTEM_LIMIT:
+            raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+        self.written += len(data)
+
+        # Note: appended chunks are collected in a list (i.e. no copying of the whole content on each append)
+        if append and isinstance(content, list):
+            if data:
+                content.append(data)
+            data = content
+        elif append and content and data:
+            data = [content, data]
+        elif append and content:
+            data = content
+
+        self.overlay[path] = data
+        if dirty and data:
+            self.dirty.add(path)
+        else:
+            self.dirty.discard(path)
+
+    def remove(self, path):
+        for key in [_ for _ in self.overlay if _.startswith(path.rstrip('/') + '/')]:
+            del self.overlay[key]
+            self.dirty.discard(key)
+
+        self.overlay[path] = None
+        self.dirty.discard(path)
+
+    def mkdir(self, path):
+        if not self.exists(path) or self.lookup(path) is not self.DIRECTORY:
+            self.overlay[path] = self.DIRECTORY
+
+    def modified(self, path):
+        """
+        Returns True if the path (or any of its parents) has been changed by the session
+        """
+
+        while True:
+            if path in self.overlay:
+                return True
+            elif posixpath.dirname(path) == path:
+                return False
+            path = posixpath.dirname(path)
+
+    def listdir(self, path):
+        if self.overlay.get(path) is self.DIRECTORY:
+            retval = set()
+        else:
+            retval = set(FILESYSTEM_DATA["tree"].get(path, ()))
+
+        for key in self.overlay:
+            if key != "/" and posixpath.dirname(key) == path:
+                retval.add(posixpath.basename(key))
+
+        return sorted(_ for _ in retval if self.exists(posixpath.join(path, _)))
+
+    def glob(self, pattern):
+        """
+        Returns (existing) paths matching the absolute shell pattern
+        """
+
+        retval = ["/"]
+
+        for part in pattern.strip('/').split('/'):
+            if not part:
+                continue
+            elif re.search(r"[*?[]", part):
+                retval = [posixpath.join(_, name) for _ in retval for name in self.listdir(_) if fnmatch.fnmatchcase(name, part) and (name[0] != '.' or part[0] == '.')]
+            else:
+                retval = [posixpath.join(_, part) for _ in retval]
+
+        return [_ for _ in retval if self.exists(_)]
+
+class Emulator(object):
+    """
+    Scripted (in-memory) busybox shell answering the usual vocabulary of bots
+    """
+
+    TOKEN_REGEX = re.compile(r"""\s*(?:(&&|\|\||[;&|<]|\d?>>|\d?>&\d|\d?>)|((?:[^\s'";&|<>\\]|\\.|'[^']*'|"(?:[^"\\]|\\.)*")+))""")
+    WORD_REGEX = re.compile(r"""'([^']*)'|"((?:[^"\\]|\\.)*)"|\\(.)|([^'"\\]+)""", re.S)
+    ESCAPE_REGEX = re.compile(r"\\(x[0-9a-fA-F]{1,2}|0[0-7]{0,3}|.)", re.S)
+    ESCAPES = {'a': '\a', 'b': '\b', 'e': '\x1b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v', '\\': '\\'}
+    PS_OUTPUT = "  PID USER       VSZ STAT COMMAND\n    1 root      1512 S    init\n    2 root         0 SW   [kthreadd]\n    3 root         0 SW   [ksoftirqd/0]\n    4 root         0 SW   [events/0]\n    5 root         0 SW   [khelper]\n   62 root      1508 S    /sbin/syslogd -n -m 0\n   64 root      1508 S    /sbin/klogd -n\n   97 root      1516 S    /usr/sbin/telnetd -F -l /bin/login\n  113 root      3712 S    /usr/bin/dvrbox\n  241 root      1520 S    -sh\n  247 root      1516 R    ps\n"
+    COMMANDS = ("cat", "cd", "chmod", "cp", "echo", "exit", "logout", "ls", "mkdir", "ps", "pwd", "rm", "sh", "tftp", "touch", "wget")
+
+    def __init__(self):
+        self.cwd = "/"
+        self.fs = VirtualFilesystem()
+        self.executed = []
+        self.exited = False
+
+    def execute(self, line):
+        """
+        Returns the output of the command line or None if it has to be run by the real shell
+        """
+
+        state = (self.cwd, dict(self.fs.overlay), set(self.fs.dirty), self.fs.written, dict((path, len(_)) for path, _ in self.fs.overlay.items() if isinstance(_, list)))
+
+        try:
+            output = self._execute(line)
+        except (ValueError, KeyError):
+            output = None
+
+        if output is None:
+            self.cwd, self.fs.overlay, self.fs.dirty, self.fs.written, lengths = state
+            for path, length in lengths.items():
+                del self.fs.overlay[path][length:]
+
+        return output
+
+    def samples(self, final=False):
+        """
+        Returns (and forgets) files written by the session that were executed (all of them if final)
+        """
+
+        paths, self.executed = (self.fs.dirty if final else self.executed), []
+        retval = [(path, self.fs.lookup(path)) for path in sorted(set(paths)) if path in self.fs.dirty]
+        self.fs.dirty.difference_update(_[0] for _ in retval)
+
+        return retval
+
+    def fallback(self, line):
+        """
+        Returns the command line to be run by the real shell (inside the emulated working directory)
+        """
+
+        # Note: real shell sees the real (chroot) filesystem, not the files written (or removed) by the session
+
+        return line if self.cwd == "/" else "cd %s 2>/dev/null; %s" % (pipes.quote(self.cwd), line)
+
+    def _unquote(self, word):
+        retval = ""
+
+        for single, double, escaped, plain in self.WORD_REGEX.findall(word):
+            if '$' in double + plain or '`' in double + plain:
+                raise ValueError("unsupported expansion")
+            retval += single or re.sub(r'\\([$`"\\])', r"\1", double) or escaped or plain
+
+        return retval
+
+    def _parse(self, line):
+        retval = [[None, [], []]]
+        position = 0
+        line = line.strip()
+
+        while position < len(line):
+            match = self.TOKEN_REGEX.match(line, position)
+            if not match or match.end() == position:
+                raise ValueError("unsupported syntax")
+
+            operator, word = match.groups()
+            position = match.end()
+
+            if operator in (";", "&", "&&", "||"):
+                retval.append([operator, [], []])
+            elif operator == "|":
+                raise ValueError("unsupported pipe")
+            elif operator:
+                if '&' in operator:
+                    retval[-1][2].append((operator, None))
+                else:
+                    match = self.TOKEN_REGEX.match(line, position)
+                    if not match or not match.group(2):
+                        raise ValueError("missing redirection target")
+                    position = match.end()
+                    retval[-1][2].append((operator, self._unquote(match.group(2))))
+            else:
+                retval[-1][1].append(self._unquote(word))
+
+        return retval
+
+    def _execute(self, line):
+        retval = ""
+        status = 0
+
+        for connector, argv, redirections in self._parse(line):
+            if self.exited or connector == "&&" and status != 0 or connector == "||" and status == 0:
+                continue
+
+            # Note: redirections are set up before the command is run (i.e. it isn't run if one of them fails)
+            targets = {1: None, 2: None}
+            try:
+                for operator, target in redirections:
+                    fd = 2 if operator[0] == '2' else 1
+                    if '&' in operator:
+                        targets[fd] = targets[int(operator[-1])]
+                    elif operator != '<':
+                        path = self._path(target)
+                        if path != "/dev/null":
+                            self.fs.write(path, "", append=operator.endswith(">>"))
+                        targets[fd] = path
+            except IOError, ex:
+                retval += "sh: can't create %s: %s\n" % (target, ex.strerror)
+                status = 1
+                continue
+
+            if argv:
+                result = self._run(argv)
+                if result is None:
+                    return None
+                stdout, stderr, status = result
+            else:
+                stdout, stderr, status = "", "", 0
+
+            for fd, data in ((1, stdout), (2, stderr)):
+                if targets[fd] is None:
+                    retval += data
+                elif targets[fd] != "/dev/null" and data:
+                    try:
+                        self.fs.write(targets[fd], data, append=True)
+                    except IOError, ex:
+                        retval += "%s: write error: %s\n" % (argv[0], ex.strerror)
+                        status = 1
+
+        return retval
+
+    def _path(self, path):
+        # Note: normpath() keeps the (POSIX implementation-defined) leading "//"
+        return "/" + posixpath.normpath(posixpath.join(self.cwd, path or "/")).lstrip('/')
+
+    def _run(self, argv):
+        name = argv[0]
+
+        if posixpath.basename(name) == "busybox":
+            if len(argv) == 1:
+                return ("%s multi-call binary.\n\nUsage: busybox [function] [arguments]...\n   or: function [arguments]...\n" % BUSYBOX_FAKE_BANNER, "", 0)
+            elif argv[1] not in BUSYBOX_APPLETS:
+                return ("", "%s: applet not found\n" % argv[1], 127)
+            argv = argv[1:]
+            name = argv[0]
+        elif posixpath.dirname(name) in ("/bin", "/sbin", "/usr/bin", "/usr/sbin"):
+            name = posixpath.basename(name)
+        elif '/' in name:
+            # Note: (dropped) executables are pretended to run
+            path = self._path(name)
+            if not self.fs.exists(path):
+                return None
+            self.executed.append(path)
+            return ("", "", 0)
+
+        if name in self.COMMANDS:
+            return getattr(self, "_cmd_%s" % name)(argv[1:])
+        elif name in BUSYBOX_APPLETS:
+            return None
+        else:
+            return ("", "sh: %s: not found\n" % name, 127)
+
+    def _cmd_cat(self, args):
+        stdout, stderr = "", ""
+
+        for arg in args:
+            try:
+                content = self.fs.lookup(self._path(arg))
+            except KeyError:
+                return None
+            if content is None:
+                stderr += "cat: can't open '%s': No such file or directory\n" % arg
+            elif content is VirtualFilesystem.DIRECTORY:
+                stderr += "cat: read error: Is a directory\n"
+            else:
+                stdout += content
+
+        return (stdout, stderr, 1 if stderr else 0)
+
+    def _cmd_cd(self, args):
+        path = self._path(args[0] if args else "/")
+
+        # Note: path unknown to the emulated filesystem (e.g. without a snapshot) doesn't exist either
+        if not self.fs.exists(path) or self.fs.lookup(path) is not VirtualFilesystem.DIRECTORY:
+            return ("", "sh: cd: can't cd to %s\n" % path, 2)
+
+        self.cwd = path
+        return ("", "", 0)
+
+    def _cmd_chmod(self, args):
+        return ("", "", 0)
+
+    def _cmd_cp(self, args):
+        args = [_ for _ in args if not _.startswith('-')]
+        if len(args) != 2:
+            return None
+
+        try:
+            content = self.fs.lookup(self._path(args[0]))
+        except KeyError:
+            return None
+
+        if content is None:
+            return ("", "cp: can't stat '%s': No such file or directory\n" % args[0], 1)
+        elif content is VirtualFilesystem.DIRECTORY:
+            return None
+
+        destination = self._path(args[1])
+        if self.fs.exists(destination) and self.fs.lookup(destination) is VirtualFilesystem.DIRECTORY:
+            destination = posixpath.join(destination, posixpath.basename(args[0]))
+
+        try:
+            self.fs.write(destination, content, dirty=False)
+        except IOError, ex:
+            return ("", "cp: can't create '%s': %s\n" % (args[1], ex.strerror), 1)
+
+        return ("", "", 0)
+
+    def _cmd_echo(self, args):
+        newline, escapes = True, False
+
+        while args and re.match(r"-[neE]+\Z", args[0]):
+            newline = newline and 'n' not in args[0]
+            escapes = 'e' in args[0]
+            args = args[1:]
+
+        retval = " ".join(args)
+        if escapes:
+            retval = retval.split("\\c")[0]
+            retval = self.ESCAPE_REGEX.sub(lambda match: self._escape(match.group(1)), retval)
+
+        return (retval + ("\n" if newline else ""), "", 0)
+
+    def _escape(self, value):
+        if value[0] == 'x':
+            return chr(int(value[1:], 16))
+        elif value[0] == '0':
+            return chr(int(value[1:] or '0', 8) & 0xff)
+        else:
+            return self.ESCAPES.get(value, "\\%s" % value)
+
+    def _cmd_exit(self, args):
+        self.exited = True
+        return ("", "", 0)
+
+    _cmd_logout = _cmd_exit
+
+    def _cmd_ls(self, args):
+        if any(_.startswith('-') and _.strip("-a1") for _ in args):
+            return None  # Note: e.g. long listing is left to the real shell
+
+        stdout, stderr = "", ""
+        paths = [_ for _ in args if not _.startswith('-')] or ["."]
+
+        for arg in paths:
+            content = self.fs.lookup(self._path(arg))
+            if content is None:
+                stderr += "ls: %s: No such file or directory\n" % arg
+            elif content is VirtualFilesystem.DIRECTORY:
+                names = [_ for _ in self.fs.listdir(self._path(arg)) if '-a' in args or not _.startswith('.')]
+                stdout += "%s%s" % ("%s:\n" % arg if len(paths) > 1 else "", "".join("%s\n" % _ for _ in names))
+            else:
+                stdout += "%s\n" % arg
+
+        return (stdout, stderr, 1 if stderr else 0)
+
+    def _cmd_mkdir(self, args):
+        for arg in args:
+            if not arg.startswith('-'):
+                path = self._path(arg)
+                if '-p' in args:
+                    for i in xrange(2, len(path.split('/')) + 1):
+                        self.fs.mkdir('/'.join(path.split('/')[:i]))
+                else:
+                    self.fs.mkdir(path)
+
+        return ("", "", 0)
+
+    def _cmd_ps(self, args):
+        return (self.PS_OUTPUT, "", 0)
+
+    def _cmd_pwd(self, args):
+        return ("%s\n" % self.cwd, "", 0)
+
+    def _cmd_rm(self, args):
+        for arg in args:
+            if not arg.startswith('-'):
+                path = self._path(arg)
+                for path in (self.fs.glob(path) if re.search(r"[*?[]", path) else (path,)):
+                    self.fs.remove(path)
+
+        return ("", "", 0)
+
+    def _cmd_sh(self, args):
+        return ("", "", 0) if not args else None
+
+    def _cmd_tftp(self, args):
+        if args:
+            return None
+        return ("", "%s multi-call binary.\n\nUsage: tftp [OPTIONS] HOST [PORT]\n\nTransfer a file from/to tftp server\n\nOptions:\n\t-l FILE\tLocal FILE\n\t-r FILE\tRemote FILE\n\t-g\tGet file\n\t-p\tPut file\n" % BUSYBOX_FAKE_BANNER, 1)
+
+    def _cmd_touch(self, args):
+        for arg in args:
+            if not arg.startswith('-'):
+                path = self._path(arg)
+                if not self.fs.exists(path):
+                    self.fs.write(path, "", dirty=False)
+
+        return ("", "", 0)
+
+    def _cmd_wget(self, args):
+        if args:
+            return None
+        return ("", "%s multi-call binary.\n\nUsage: wget [-c|--continue] [-s|--spider] [-q|--quiet] [-O|--output-document FILE]\n\t[--header 'header: value'] [-Y|--proxy on/off] [-P DIR]\n\t[-U|--user-agent AGENT] URL...\n\nRetrieve files via HTTP or FTP\n" % BUSYBOX_FAKE_BANNER, 1)
 
 class HoneyTelnetHandler(TelnetHandler):
     WELCOME = WELCOME
@@ -53,80 +1641,447 @@ class HoneyTelnetHandler(TelnetHandler):
 
     PROMPT_USER = "%s login: " % HOSTNAME
     PROMPT_PASS = "Password: "
+    NEGOTIATION_TIMEOUT = NEGOTIATION_TIMEOUT
 
     authNeedUser = AUTH_USERNAME is not None
     authNeedPass = AUTH_PASSWORD is not None
     process = None
+    emulator = None
+    shell_used = False
+    marker = None
+    marker_regex = None
+    marker_count = 0
+    output_written = 0
+    pty_pending = ""
+    pty_input = ""
+    pty_lock = None
+    last_input = 0
+    timers = None
+    finished = False
 
     def write(self, text):
-        for key, value in REPLACEMENTS.items():
-            text = text.replace(key, value)
-        TelnetHandler.write(self, text)
+        self.writecooked(_cook(str(text)))
 
     def _readline_echo(self, char, echo):
-        if "^C ABORT" in char:
+        # Note: exact match as char can also be a whole (e.g. pasted) line
+        if char == "\n^C ABORT\n":
             char = "^C\n"
             if self.process:
                 os.killpg(self.process.pid, signal.SIGINT)
         if self._readline_do_echo(echo):
             self.write(char)
 
+    def _inputcooker_recv(self):
+        TelnetHandler._inputcooker_recv(self)
+        self.last_input = time.time()
+
+    def _deadline(self, name, timeout):
+        """
+        Called by the timer wheel once the session's deadline has passed
+        """
+
+        if self.finished:
+            return
+
+        if name == "idle":
+            remaining = self.last_input + timeout - time.time()
+            if remaining > 0:
+                self.timers[name] = TIMER_WHEEL.schedule(remaining, self._deadline, name, timeout)
+                return
+
+        self._log("TIMEOUT", "%s (%ds)" % (name, timeout))
+        self.RUNSHELL = False
+
+        # Note: wakes up the session (input cooker gets EOF) which then tears itself down (finish() -> session_end())
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
     def _log(self, logtype, msg=None):
         line = '[%s] [%s:%s] %s%s\n' % (time.strftime(TIME_FORMAT, time.localtime(time.time())), self.client_address[0], self.client_address[1], logtype, ": %s" % msg if msg is not None else "")
         os.write(self._getLogHandle(), line)
 
-    def _getLogHandle(self):
-        if LOG_PATH != getattr(THREAD_DATA, "logPath", None):
+    @staticmethod
+    def _getLogHandle():
+        # Note: single (process-wide) handle as appending writes are atomic (i.e. no need for one per thread/greenlet)
+        if LOG_PATH != LOG_DATA.get("logPath"):
             if not os.path.exists(LOG_PATH):
                 open(LOG_PATH, "w+").close()
                 os.chmod(LOG_PATH, LOG_FILE_PERMISSIONS)
-            THREAD_DATA.logPath = LOG_PATH
-            THREAD_DATA.logHandle = os.open(THREAD_DATA.logPath, LOG_HANDLE_FLAGS)
-        return THREAD_DATA.logHandle
+            LOG_DATA["logPath"] = LOG_PATH
+            LOG_DATA["logHandle"] = os.open(LOG_PATH, LOG_HANDLE_FLAGS)
+        return LOG_DATA["logHandle"]
+
+    def _ptyOutput(self, data):
+        """
+        Called by the reactor with the output of the pseudo-terminal shell
+        """
+
+        allowed = SESSION_OUTPUT_LIMIT - self.output_written
+        self.output_written += len(data)
+        self.pty_pending += _cook(data[:max(0, allowed)])
+        self._ptySend()
+
+        if self.output_written >= SESSION_OUTPUT_LIMIT:
+            self._log("LIMIT", "session output (%d bytes)" % SESSION_OUTPUT_LIMIT)
+            REACTOR.unregister(self.process.master)
+            self._ptyClosed()
+
+    def _ptySend(self):
+        """
+        Sends (without blocking the reactor) as much of the pending output as the client accepts
+        """
+
+        # Note: underlying socket under gevent (i.e. its send() would wait for the socket instead of failing)
+        sock = getattr(self.sock, "_sock", self.sock)
+
+        try:
+            sent = sock.send(self.pty_pending, socket.MSG_DONTWAIT) if self.pty_pending else 0
+        except socket.error, ex:
+            if ex.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                REACTOR.unregister(self.process.master)
+                self._ptyClosed()
+                return
+            sent = 0
+
+        self.pty_pending = self.pty_pending[sent:]
+
+        if len(self.pty_pending) > PTY_OUTPUT_BACKLOG:
+            self._log("LIMIT", "client backlog (%d bytes)" % PTY_OUTPUT_BACKLOG)
+            REACTOR.unregister(self.process.master)
+            self._ptyClosed()
+        elif self.pty_pending and not self.finished:
+            REACTOR.writable(self.sock.fileno(), self._ptySend)
+
+    def _ptyWrite(self, data=""):
+        """
+        Writes (without blocking) as much of the pending input as the pseudo-terminal shell accepts (rest once the reactor finds it writable)
+        """
 
-    def _retrieve_url(self, url, filename=None):
+        with self.pty_lock:
+            self.pty_input += data
+
+            while self.pty_input and not self.finished:
+                try:
+                    self.pty_input = self.pty_input[os.write(self.process.master, self.pty_input):]
+                except OSError, ex:
+                    if ex.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        self.pty_input = ""  # Note: e.g. EIO once the shell has exited
+                    break
+
+            if len(self.pty_input) > PTY_INPUT_BACKLOG:
+                self._log("LIMIT", "shell backlog (%d bytes)" % PTY_INPUT_BACKLOG)
+                self.pty_input = ""
+                self._ptyClosed()
+            elif self.pty_input and not self.finished:
+                REACTOR.writable(self.process.master, self._ptyWrite)
+
+    def _ptyClosed(self):
+        """
+        Called by the reactor once the pseudo-terminal shell is gone
+        """
+
+        # Note: wakes up the session (input cooker gets EOF)
         try:
-            filename, _ = urllib.urlretrieve(url, filename)
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def _ptyRelay(self):
+        """
+        Relays client's input to the pseudo-terminal shell (output is relayed by the reactor)
+        """
+
+        keys = dict((code, sequence) for sequence, code in self.ESCSEQ.items())
+        line = ""
+
+        while self.RUNSHELL and self.process.poll() is None:
+            data = self.getline_ready() or self.getc(block=True)
+            if not isinstance(data, basestring):
+                data = keys.get(data, "")
+
+            for char in data:
+                if char == "\n":
+                    self._log("CMD", line.strip())
+                    self._capture(line)
+                    line = ""
+                elif char in ("\x7f", "\x08"):
+                    line = line[:-1]
+                elif char >= " ":
+                    line += char
+
+            self.shell_used = True
+            if RUN_ATTACKERS_COMMANDS:
+                self._ptyWrite(data)
+            elif "\n" in data:
+                self._ptyWrite("\n")
+
+    def _capture(self, raw):
+        """
+        Schedules retrieval of sample(s) referenced inside the attacker's command
+        """
+
+        for protocol, url, target in _fetches(raw):
+            if protocol not in ("http", "https"):
+                self._log("DOWNLOAD", "%s (unsupported protocol)" % url)
+                continue
+
+            # Note: attacker's (malformed) input must never take the session down
+            try:
+                sha256 = SAMPLE_STORE.lookup(url)
+                if sha256:
+                    self._captureDownload(url, sha256, None, True)
+                elif not DOWNLOADER.enqueue(url, self._captureDownload):
+                    self._log("DOWNLOAD", "%s (queue full)" % url)
+            except Exception, ex:
+                self._log("DOWNLOAD", "%s (%s)" % (url, str(ex) or type(ex).__name__))
+
+    def _captureDownload(self, url, sha256, error, cached=False):
+        """
+        Called by the download worker once the sample has been stored (or failed to)
+        """
+
+        if error:
+            self._log("DOWNLOAD", "%s (%s)" % (url, error))
+        else:
+            SAMPLE_STORE.seen(sha256, self.client_address[0], url)
+            self._log("SAMPLE", "%s (%s%s)" % (SAMPLE_STORE.path(sha256), url, ", cached" if cached else ""))
+            if PREFETCHER and not cached:
+                PREFETCHER.siblings(url, self._capturePrefetch)
+
+    def _capturePrefetch(self, url, sha256, error):
+        """
+        Called by the prefetch worker once the sibling sample has been stored (failures are expected)
+        """
+
+        if not error:
+            self._log("SAMPLE", "%s (%s, prefetched)" % (SAMPLE_STORE.path(sha256), url))
+
+    def _captureData(self, path, data):
+        """
+        Stores file written (e.g. by an echo dropper) inside the emulated filesystem as a sample
+        """
+
+        try:
+            writer = SampleWriter()
+            writer.write(data)
+            sha256 = SAMPLE_STORE.store(writer, posixpath.basename(path))
+            SAMPLE_STORE.seen(sha256, self.client_address[0])
+            self._log("SAMPLE", "%s (%s)" % (SAMPLE_STORE.path(sha256), path))
         except:
-            filename = None
-        return filename
-
-    def _md5(self, filename):
-        md5 = hashlib.md5()
-        with open(filename, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                md5.update(chunk)
-        return md5.hexdigest()
-
-    def _processRead(self):
-        result = ""
-        while self.process.poll() is None:
+            pass
+
+    def _writeCharged(self, output):
+        """
+        Writes (cooked) output not coming from the shell charged to the session's output budget (returns False once exhausted)
+        """
+
+        allowed = SESSION_OUTPUT_LIMIT - self.output_written
+        self.output_written += len(output)
+        self.writecooked(output[:max(0, allowed)])
+
+        if len(output) > allowed:
+            self._log("LIMIT", "session output (%d bytes)" % SESSION_OUTPUT_LIMIT)
+            return False
+
+        return True
+
+    def _processWrite(self, command):
+        """
+        Sends command to the shell followed by (unguessable) end-of-command marker
+        """
+
+        if self.marker is None:
+            self.marker = os.urandom(8).encode("hex")
+            self.marker_regex = re.compile(r"\n%s_(\d+)\n" % self.marker)
+
+        # Note: e.g. echo of the command line is sent out before (possibly) blocking on the shell
+        self.flush()
+
+        # Note: command's stdin is detached from the shell's (e.g. bare 'cat' would otherwise read, and echo, the marker line)
+        self.marker_count += 1
+        self.process.stdin.write("{\n%s\n} </dev/null\nprintf '\\n%s_%d\\n'\n" % (command, self.marker, self.marker_count))
+
+    def _processKill(self):
+        """
+        Kills the currently running command(s) while keeping the shell itself alive (returns False if the whole shell had to be killed)
+        """
+
+        found = False
+
+        try:
+            for pid in os.listdir("/proc"):
+                if pid.isdigit() and int(pid) != self.process.pid:
+                    try:
+                        with open("/proc/%s/stat" % pid, "rb") as f:
+                            content = f.read()
+                        if int(content[content.rfind(")") + 2:].split()[2]) == self.process.pid:
+                            os.kill(int(pid), signal.SIGKILL)
+                            found = True
+                    except (IOError, OSError, ValueError, IndexError):
+                        pass
+        except OSError:  # Note: e.g. /proc not mounted inside the chroot
+            pass
+
+        if not found:
+            # Note: fresh shell is (lazily) started for the next command
+            _kill_shell(self.process)
+            self.process = None
+
+        return found
+
+    def _processRelay(self, collect=False):
+        """
+        Streams the output of the last command (i.e. up to its end-of-command marker) to the client
+        """
+
+        fd = self.process.stdout.fileno()
+        deadline = time.time() + COMMAND_TIMEOUT
+
+        # Note: select() can't handle descriptors >= FD_SETSIZE (1024), i.e. it fails with hundreds of concurrent sessions
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        pending = ""
+        written = 0
+        killed = False
+        done = False
+        collected = []
+
+        while not done:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                if killed:
+                    break
+                self._log("LIMIT", "command timeout (%ds)" % COMMAND_TIMEOUT)
+                if not self._processKill():
+                    break
+                killed = True
+                deadline = time.time() + 1
+                continue
+
+            self.flush()
+            if not poller.poll(remaining * 1000):
+                continue
+
             try:
-                buf = os.read(self.process.stdout.fileno(), READ_SIZE)
-                buf = re.sub(r"%s: line \d+: " % SHELL, "", buf)
-                result += buf
+                buf = os.read(fd, READ_SIZE)
             except OSError:
-                break
-        return result
+                continue
+
+            if not buf:
+                # Note: shell is exiting (e.g. 'exit')
+                while self.process.poll() is None and time.time() < deadline:
+                    time.sleep(0.01)
+                chunk, pending, done = pending, "", True
+            else:
+                pending += SHELL_ERROR_REGEX.sub("", buf)
+                match = next((_ for _ in self.marker_regex.finditer(pending) if int(_.group(1)) == self.marker_count), None)
+                if match:
+                    chunk, pending, done = pending[:match.start()], "", True
+                else:
+                    # Note: markers of previous (timed out) commands
+                    pending = self.marker_regex.sub("", pending)
+
+                    # Note: holding back only what could be the beginning of the marker
+                    cut = pending.rfind("\n", max(0, len(pending) - len(self.marker) - 24))
+                    if cut < 0:
+                        cut = len(pending)
+                    chunk, pending = pending[:cut], pending[cut:]
+
+            chunk = self.marker_regex.sub("", chunk)
+            if not chunk or killed:
+                continue
+
+            allowed = min(COMMAND_OUTPUT_LIMIT - written, SESSION_OUTPUT_LIMIT - self.output_written)
+            if len(chunk) > allowed:
+                chunk = chunk[:max(0, allowed)]
+                killed = True
+
+            written += len(chunk)
+            self.output_written += len(chunk)
+            self.write(chunk)
+            self.flush()
+
+            if collect:
+                collected.append(chunk)
+
+            if killed:
+                if self.output_written >= SESSION_OUTPUT_LIMIT:
+                    self._log("LIMIT", "session output (%d bytes)" % SESSION_OUTPUT_LIMIT)
+                    _kill_shell(self.process)
+                    break
+                self._log("LIMIT", "command output (%d bytes)" % COMMAND_OUTPUT_LIMIT)
+                if not self._processKill():
+                    break
+                deadline = min(deadline, time.time() + 1)
+
+        if collect and done and not killed:
+            return "".join(collected)
 
     def handleException(self, exc_type, exc_param, exc_tb):
         return False
 
     def session_start(self):
         self._log("SESSION_START")
-        self.process = subprocess.Popen(SHELL, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
 
-        flags = fcntl.fcntl(self.process.stdout, fcntl.F_GETFL)
-        fcntl.fcntl(self.process.stdout, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        # Note: real shell is (lazily) started only for commands unknown to the emulator
+        if EMULATE_SHELL and not USE_PTY:
+            self.emulator = Emulator()
+        else:
+            self._shellStart()
+
+    def _shellStart(self):
+        if SHELL_POOL:
+            self.process = SHELL_POOL.get()
+        else:
+            self.process = _spawn_shell()
+
+        if self.process.master is not None:
+            # Note: reactor relays (i.e. consumes) the shell's initial prompt right away, hence such shell can't be recycled
+            self.shell_used = True
+            self.pty_lock = threading.Lock()
+
+            # Note: (buffered) output written so far (e.g. CRLF after the password) has to precede the shell's prompt
+            self.flush()
+            REACTOR.register(self.process.master, self)
 
     def session_end(self):
-        self._log("SESSION_END")
+        self.finished = True
+
+        for timer in (self.timers or {}).values():
+            TIMER_WHEEL.cancel(timer)
+
+        try:
+            if self.emulator:
+                for path, data in self.emulator.samples(final=True):
+                    self._captureData(path, data)
+
+            self._log("SESSION_END")
+        finally:
+            # Note: teardown of the shell (whole process group) and the socket has to happen no matter what
+            if self.process:
+                if self.process.master is not None:
+                    REACTOR.unregister(self.process.master)
+                    REACTOR.unregister(self.sock.fileno())
+                if SHELL_POOL:
+                    SHELL_POOL.release(self.process, self.shell_used)
+                else:
+                    _kill_shell(self.process)
 
-        # Reference: https://github.com/ianepperson/telnetsrvlib/blob/master/telnetsrv/telnetsrvlib.py#L534-L546
-        #            https://stackoverflow.com/a/598759
-        self.sock.close()
+            # Reference: https://github.com/ianepperson/telnetsrvlib/blob/master/telnetsrv/telnetsrvlib.py#L534-L546
+            #            https://stackoverflow.com/a/598759
+            self.sock.close()
 
     def handle(self):
+        self._log("NEGOTIATION", "%.3fs" % self.negotiation_time if self.negotiation_time is not None else "timeout")
+
+        self.last_input = time.time()
+        self.timers = {}
+        for name, timeout in (("login", LOGIN_TIMEOUT), ("idle", IDLE_TIMEOUT), ("session", SESSION_TIMEOUT)):
+            if timeout:
+                self.timers[name] = TIMER_WHEEL.schedule(timeout, self._deadline, name, timeout)
+
         if TELNET_ISSUE:
             self.writeline(TELNET_ISSUE)
 
@@ -138,12 +2093,18 @@ class HoneyTelnetHandler(TelnetHandler):
         if not authenticated:
             return
 
+        TIMER_WHEEL.cancel(self.timers.pop("login", None))
+
         if self.DOECHO and self.WELCOME:
             self.writeline(self.WELCOME)
 
         self.session_start()
 
-        while self.RUNSHELL and self.process.poll() is None:
+        if USE_PTY:
+            self._ptyRelay()
+            return
+
+        while self.RUNSHELL and (self.process is None or self.process.poll() is None):
             line = self.input_reader(self, self.readline(prompt=self.PROMPT).strip())
             raw = line.raw
             cmd = line.cmd
@@ -158,30 +2119,48 @@ class HoneyTelnetHandler(TelnetHandler):
                 except:
                     pass
 
-            try:
-                match = re.search(r"(?i)(wget|curl).+(http[^ >;\"']+)", raw)
-                if match:
-                    url = match.group(2)
-                    original = posixpath.split(urlparse.urlsplit(url).path)[-1]
-                    filename = self._retrieve_url(url)
-                    if filename:
-                        destination = os.path.join(SAMPLES_DIR, "%s_%s" % (original, self._md5(filename)))
-                        shutil.move(filename, destination)
-                        self._log("SAMPLE", destination)
-            except:
-                pass
+            self._capture(raw)
+
+            key = None
+            if RESPONSE_CACHE and RUN_ATTACKERS_COMMANDS:
+                key = RESPONSE_CACHE.key(raw)
+                if key and self.emulator and any(self.emulator.fs.modified(_) for _ in re.findall(r"/[^\s;&|]*", raw)):
+                    key = None
+                if key:
+                    response = RESPONSE_CACHE.get(key)
+                    if response is not None:
+                        if not self._writeCharged(response):
+                            break
+                        continue
+
+            if self.emulator:
+                output = self.emulator.execute(raw if RUN_ATTACKERS_COMMANDS else "")
+                for path, data in self.emulator.samples():
+                    self._captureData(path, data)
+                if output is not None:
+                    output = _cook(output)
+                    if key:
+                        RESPONSE_CACHE.put(key, output)
+                    if not self._writeCharged(output) or self.emulator.exited:
+                        break
+                    continue
+                raw = self.emulator.fallback(raw.strip())
+
+            if self.process is None:
+                self._shellStart()
 
             try:
+                self.shell_used = True
                 if RUN_ATTACKERS_COMMANDS:
-                    self.process.stdin.write(raw.strip() + "\n")
+                    self._processWrite(raw.strip())
                 else:
-                    self.process.stdin.write("\n")
+                    self._processWrite("")
             except IOError, ex:
                 raise
-            finally:
-                time.sleep(0.1)
 
-            self.write(self._processRead())
+            output = self._processRelay(collect=key is not None)
+            if output is not None:
+                RESPONSE_CACHE.put(key, _cook(output))
 
     def authCallback(self, username, password):
         if username is not None and password is not None:
@@ -192,9 +2171,34 @@ class HoneyTelnetHandler(TelnetHandler):
 
 class TelnetServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     allow_reuse_address = True
+    request_queue_size = LISTEN_BACKLOG
+
+    def handle_error(self, request, client_address):
+        if sys.exc_info()[0] is not EOFError:  # Note: client disconnected while handler was waiting for input
+            SocketServer.TCPServer.handle_error(self, request, client_address)
+
+def _stats():
+    """
+    Logs the operational statistics of the whole server (periodically, i.e. not per session)
+    """
+
+    TIMER_WHEEL.schedule(STATS_INTERVAL, _stats)
+
+    for logtype, source in (("SHELL_POOL", SHELL_POOL), ("RESPONSE_CACHE", RESPONSE_CACHE)):
+        if source:
+            line = '[%s] [%s:%s] %s: %s\n' % (time.strftime(TIME_FORMAT, time.localtime(time.time())), LISTEN_ADDRESS, LISTEN_PORT, logtype, source.stats())
+            os.write(HoneyTelnetHandler._getLogHandle(), line)
 
 def main():
     global SHELL
+    global SHELL_POOL
+    global REACTOR
+    global RESPONSE_CACHE
+    global TIMER_WHEEL
+    global DOWNLOADER
+    global SAMPLE_STORE
+    global SHELL_ERROR_REGEX
+    global PREFETCHER
 
     REPLACEMENTS[HOSTNAME] = FAKE_HOSTNAME
     REPLACEMENTS["Ubuntu"] = "Debian"
@@ -231,14 +2235,56 @@ def main():
     else:
         SHELL = "/bin/bash"
 
+    SHELL_ERROR_REGEX = re.compile(r"%s: line \d+: " % re.escape(SHELL))
+
     if not os.path.isdir(SAMPLES_DIR):
         try:
             os.mkdir(SAMPLES_DIR)
         except:
             exit("[!] unable to create sample directory '%s'" % SAMPLES_DIR)
 
+    SAMPLE_STORE = SampleStore(os.path.join(SAMPLES_DIR, "index.sqlite"))
+
+    # Note: forked before any other thread (or shell) is started
+    for index in xrange(TRIAGE_WORKERS):
+        process = multiprocessing.Process(target=_triage_worker, args=(index, TRIAGE_WORKERS, os.path.join(SAMPLES_DIR, "index.sqlite")))
+        process.daemon = True
+        process.start()
+
+    if USE_PTY:
+        REACTOR = Reactor()
+
+    if EMULATE_SHELL:
+        _load_filesystem()
+
+    TIMER_WHEEL = TimerWheel()
+
+    if RESPONSE_CACHE_SIZE > 0:
+        RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_REGEX, RESPONSE_CACHE_BYTES)
+
+    if SHELL_POOL_SIZE > 0:
+        SHELL_POOL = ShellPool(SHELL_POOL_SIZE)
+
+    DOWNLOADER = DownloadManager(DOWNLOAD_WORKERS, DOWNLOAD_HOST_LIMIT, DOWNLOAD_QUEUE_SIZE)
+
+    if PREFETCH_SIBLINGS:
+        PREFETCHER = SiblingPrefetcher(PREFETCH_ARCHITECTURES, PREFETCH_QUEUE_SIZE)
+
+    if STATS_INTERVAL > 0:
+        TIMER_WHEEL.schedule(STATS_INTERVAL, _stats)
+
     try:
-        server = TelnetServer((LISTEN_ADDRESS, LISTEN_PORT), HoneyTelnetHandler)
+        if USE_GEVENT:
+            try:
+                _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            except (ValueError, resource.error):
+                pass
+
+            server = StreamServer((LISTEN_ADDRESS, LISTEN_PORT), HoneyTelnetHandler.streamserver_handle, backlog=LISTEN_BACKLOG)
+            server.init_socket()
+        else:
+            server = TelnetServer((LISTEN_ADDRESS, LISTEN_PORT), HoneyTelnetHandler)
     except socket.error, ex:
         if "Permission denied" in str(ex):
             exit("[!] not enough permissions to listen on '%s:%s'" % (LISTEN_ADDRESS, LISTEN_PORT))
@@ -10,6 +10,8 @@ class TelnetHandler(TelnetHandlerBase):
     def __init__(self, request, client_address, server):
         # Create a green queue for input handling
         self.cookedq = eventlet.queue.Queue()
+        # Set once the client has answered the initial options
+        self.negotiated = eventlet.event.Event()
         # Call the base class init method
         TelnetHandlerBase.__init__(self, request, client_address, server)
 
@@ -20,8 +22,12 @@ class TelnetHandler(TelnetHandlerBase):
         self.greenlet_ic = eventlet.spawn(self.inputcooker)
         # Note that inputcooker exits on EOF
 
-        # Sleep for 0.5 second to allow options negotiation
-        eventlet.sleep(0.5)
+        # Wait (at most NEGOTIATION_TIMEOUT) for the options negotiation
+        self.negotiated.wait(self.NEGOTIATION_TIMEOUT)
+
+    def negotiation_done(self):
+        '''Called once the client has answered all initial options'''
+        self.negotiated.send()
 
     def finish(self):
         '''Called as the session is ending'''
@@ -32,12 +38,28 @@ class TelnetHandler(TelnetHandlerBase):
 
     # -- Green input handling functions --
 
-    def getc(self, block=True):
-        """Return one character from the input queue"""
+    def getc(self, block=True, timeout=None):
+        """Return one character from the input queue ('' on timeout)"""
+        if block and self.cookedq.empty():
+            # About to wait for the client - send out everything it should see first
+            self.flush()
         try:
-            return self.cookedq.get(block)
+            ret = self.cookedq.get(block, timeout)
         except eventlet.queue.Empty:
             return ''
+        if ret is None:
+            # EOF marker (see inputcooker) - leave it for the next caller
+            self.cookedq.put(None)
+            raise EOFError
+        return ret
+
+    def inputcooker(self):
+        """Input cooker - wake up any waiting reader once it exits"""
+        try:
+            TelnetHandlerBase.inputcooker(self)
+        finally:
+            self.eof = 1
+            self.cookedq.put(None)
 
     def inputcooker_socket_ready(self):
         """Indicate that the socket is ready to be read"""
@@ -23,9 +23,12 @@ Various settings can affect the operation of the server:
 """
 
 import SocketServer
+import re
 import socket
 import struct
 import sys
+import threading
+import time
 import traceback
 import curses.ascii
 import curses.has_key
@@ -36,6 +39,12 @@ import logging
 
 log = logging.getLogger(__name__)
 
+# Process-wide cache of per terminal type structures (ESCSEQ, ESCTRIE, PLAINRE, CODES)
+# as curses.setupterm is slow, works on global state and isn't thread safe
+TERMCACHE = {}
+TERMCACHE_LOCK = threading.Lock()
+TERMCACHE_SIZE = 256
+
 BELL = chr(7)
 ESC  = chr(27)
 ANSI_START_SEQ = '['
@@ -406,6 +415,12 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
     # Reverse mapping of KEYS - used for cooking key codes
     ESCSEQ = {
     }
+    # ESCSEQ compiled into a prefix tree - {char: {char: ..., None: keycode}}
+    ESCTRIE = {
+    }
+    # Raw characters that can't be passed to the cooked queue as they are
+    # (IAC, CR and the first characters of ESCSEQ - see setterm)
+    PLAINRE = re.compile('[^%s]+' % re.escape(IAC + chr(13)))
     # Terminal output escape sequences
     CODES = {
         'DEOL': '', # Delete to end of line
@@ -437,6 +452,12 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
     PROMPT_USER = "Username: "
     # What prompt to use when requesting a telnet password
     PROMPT_PASS = "Password: "
+    # Size of the (reusable) raw input buffer
+    RAWBUF_SIZE = 4096
+    # How long to wait for the client to answer the initial options (seconds)
+    NEGOTIATION_TIMEOUT = 0.5
+    # Send out the buffered output once it grows that big
+    OUTBUF_SIZE = 4096
 
 # --------------------------- Environment Setup ----------------------------
 
@@ -453,36 +474,61 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
         self.DOOPTS = {}
         # What opts have I sent WILL/WONT for and what did I send?
         self.WILLOPTS = {}
+        # Initial opts still waiting for an answer - (WILL or DO, opt)
+        self.negotiation_pending = set()
+        self.negotiation_start = None
+        # How long did the initial options negotiation take (None if unfinished)
+        self.negotiation_time = None
 
         # What commands does this CLI support
         self.COMMANDS = {}
         self.sock = None    # TCP socket
-        self.rawq = ''      # Raw input string
+        self.rawq = ''      # Raw input string (pushed back by the input cooker)
+        self.rawbuf = bytearray(self.RAWBUF_SIZE)   # Raw input (receive) buffer
+        self.rawview = memoryview(self.rawbuf)
+        self.rawpos = 0     # Read offset inside rawbuf
+        self.rawlen = 0     # Amount of received data inside rawbuf
+        self.outbuf = []    # Output waiting to be sent (see flush)
+        self.outbuf_len = 0
         self.sbdataq = ''   # Sub-Neg string
         self.eof = 0        # Has EOF been reached?
         self.iacseq = ''    # Buffer for IAC sequence.
         self.sb = 0     # Flag for SB and SE sequence.
         self.history = []   # Command history
         self.RUNSHELL = True
-        # A little magic - Everything called cmdXXX is a command
-        # Also, check for decorated functions
-        for k in dir(self):
-            method = getattr(self, k)
-            try:
-                name = method.command_name
-            except:
-                if k[:3] == 'cmd':
-                    name = k[3:]
-                else:
-                    continue
-            
-            name = name.upper()
-            self.COMMANDS[name] = method
-            for alias in getattr(method, "aliases", []):
-                self.COMMANDS[alias.upper()] = self.COMMANDS[name]
-                    
+        # Bind the (per class cached) commands to this instance
+        methods = {}
+        for name, k in self._commands():
+            if k not in methods:
+                methods[k] = getattr(self, k)
+            self.COMMANDS[name] = methods[k]
+
         SocketServer.BaseRequestHandler.__init__(self, request, client_address, server)
     
+    @classmethod
+    def _commands(cls):
+        """Return the list of (command name, attribute name) supported by
+        this class. Built only once per class as dir() is expensive."""
+        if '_COMMANDS' not in cls.__dict__:
+            commands = []
+            # A little magic - Everything called cmdXXX is a command
+            # Also, check for decorated functions
+            for k in dir(cls):
+                method = getattr(cls, k)
+                try:
+                    name = method.command_name
+                except:
+                    if k[:3] == 'cmd':
+                        name = k[3:]
+                    else:
+                        continue
+
+                commands.append((name.upper(), k))
+                for alias in getattr(method, "aliases", []):
+                    commands.append((alias.upper(), k))
+            cls._COMMANDS = commands
+        return cls._COMMANDS
+
     class false_request(object):
         def __init__(self):
             self.sock = None
@@ -496,26 +542,53 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
         log.debug("Accepted connection, starting telnet session.")
         try:
             cls(request, address, server)
-        except socket.error:
+        except (socket.error, EOFError):
             pass
 
     def setterm(self, term):
         "Set the curses structures for this terminal"
         log.debug("Setting termtype to %s" % (term, ))
-        curses.setupterm(term) # This will raise if the termtype is not supported
+        key = (term, tuple(sorted(self.KEYS.keys())), tuple(sorted(self.CODES.keys())))
+        entry = TERMCACHE.get(key)
+        if entry is None:
+            with TERMCACHE_LOCK:
+                entry = TERMCACHE.get(key)
+                if entry is None:
+                    try:
+                        entry = self._termentry(term)
+                    except curses.error, ex:
+                        entry = ex
+                    if len(TERMCACHE) < TERMCACHE_SIZE:
+                        TERMCACHE[key] = entry
+        if isinstance(entry, Exception):
+            raise entry # The termtype is not supported
         self.TERM = term
-        self.ESCSEQ = {}
+        # Note: shared between all sessions with the same termtype (read-only)
+        self.ESCSEQ, self.ESCTRIE, self.PLAINRE, self.CODES = entry
+
+    def _termentry(self, term):
+        "Query curses for the structures of this terminal (call with TERMCACHE_LOCK held)"
+        curses.setupterm(term) # This will raise if the termtype is not supported
+        escseq = {}
         for k in self.KEYS.keys():
             str = curses.tigetstr(curses.has_key._capability_names[k])
             if str:
-                self.ESCSEQ[str] = k
+                escseq[str] = k
         # Create a copy to prevent altering the class
-        self.CODES = self.CODES.copy()
-        self.CODES['DEOL'] = curses.tigetstr('el')
-        self.CODES['DEL'] = curses.tigetstr('dch1')
-        self.CODES['INS'] = curses.tigetstr('ich1')
-        self.CODES['CSRLEFT'] = curses.tigetstr('cub1')
-        self.CODES['CSRRIGHT'] = curses.tigetstr('cuf1')
+        codes = self.CODES.copy()
+        codes['DEOL'] = curses.tigetstr('el')
+        codes['DEL'] = curses.tigetstr('dch1')
+        codes['INS'] = curses.tigetstr('ich1')
+        codes['CSRLEFT'] = curses.tigetstr('cub1')
+        codes['CSRRIGHT'] = curses.tigetstr('cuf1')
+        esctrie = {}
+        for keyseq, k in escseq.items():
+            node = esctrie
+            for char in keyseq:
+                node = node.setdefault(char, {})
+            node[None] = k
+        plainre = re.compile('[^%s]+' % re.escape(IAC + chr(13) + ''.join(esctrie.keys())))
+        return escseq, esctrie, plainre, codes
 
     def setup(self):
         "Connect incoming connection to a telnet session"
@@ -525,15 +598,35 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
             pass
         self.setterm(self.TERM)
         self.sock = self.request._sock
+        # Send the whole options preamble at once
+        # (only WILL/DO requests are awaited - RFC 1143 clients stay silent on DONT/WONT for options already off)
+        preamble = ''
         for k in self.DOACK.keys():
-            self.sendcommand(self.DOACK[k], k)
+            command = self._command(self.DOACK[k], k)
+            if command:
+                preamble += command
+                if self.DOACK[k] == WILL:
+                    self.negotiation_pending.add((DO, k))
         for k in self.WILLACK.keys():
-            self.sendcommand(self.WILLACK[k], k)
-        
+            command = self._command(self.WILLACK[k], k)
+            if command:
+                preamble += command
+                if self.WILLACK[k] == DO:
+                    self.negotiation_pending.add((WILL, k))
+        self.negotiation_start = time.time()
+        if preamble:
+            self.writecooked(preamble)
+            self.flush()
+        if not self.negotiation_pending:
+            self._negotiated(None, None)
+
 
     def finish(self):
         "End this session"
         log.debug("Session disconnected.")
+        try:
+            self.flush()
+        except: pass
         try:
             self.sock.shutdown(socket.SHUT_RDWR)
         except: pass
@@ -545,6 +638,10 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
     def session_end(self):
         pass
 
+    def negotiation_done(self):
+        """Called (from the input cooker) once the client has answered all initial options"""
+        pass
+
 # ------------------------- Telnet Options Engine --------------------------
 
     def options_handler(self, sock, cmd, opt):
@@ -552,6 +649,7 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
         if cmd == NOP:
             self.sendcommand(NOP)
         elif cmd == WILL or cmd == WONT:
+            self._negotiated(WILL, opt)
             if self.WILLACK.has_key(opt):
                 self.sendcommand(self.WILLACK[opt], opt)
             else:
@@ -559,6 +657,7 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
             if cmd == WILL and opt == TTYPE:
                 self.writecooked(IAC + SB + TTYPE + SEND + IAC + SE)
         elif cmd == DO or cmd == DONT:
+            self._negotiated(DO, opt)
             if self.DOACK.has_key(opt):
                 self.sendcommand(self.DOACK[opt], opt)
             else:
@@ -579,24 +678,39 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
         else:
             log.debug("Unhandled option: %s %s" % (cmdtxt, opttxt, ))
 
-    def sendcommand(self, cmd, opt=None):
-        "Send a telnet command (IAC)"
+    def _negotiated(self, cmd, opt):
+        "Mark an initial option as answered (cmd is WILL for WILL/WONT, DO for DO/DONT)"
+        if self.negotiation_time is None:
+            self.negotiation_pending.discard((cmd, opt))
+            if not self.negotiation_pending:
+                self.negotiation_time = time.time() - self.negotiation_start
+                self.negotiation_done()
+
+    def _command(self, cmd, opt=None):
+        "Return a telnet command (IAC) to send ('' if the option is already in that state)"
         if cmd in [DO, DONT]:
             if not self.DOOPTS.has_key(opt):
                 self.DOOPTS[opt] = None
             if (((cmd == DO) and (self.DOOPTS[opt] != True))
             or ((cmd == DONT) and (self.DOOPTS[opt] != False))):
                 self.DOOPTS[opt] = (cmd == DO)
-                self.writecooked(IAC + cmd + opt)
+                return IAC + cmd + opt
         elif cmd in [WILL, WONT]:
             if not self.WILLOPTS.has_key(opt):
                 self.WILLOPTS[opt] = ''
             if (((cmd == WILL) and (self.WILLOPTS[opt] != True))
             or ((cmd == WONT) and (self.WILLOPTS[opt] != False))):
                 self.WILLOPTS[opt] = (cmd == WILL)
-                self.writecooked(IAC + cmd + opt)
+                return IAC + cmd + opt
         else:
-            self.writecooked(IAC + cmd)
+            return IAC + cmd
+        return ''
+
+    def sendcommand(self, cmd, opt=None):
+        "Send a telnet command (IAC)"
+        command = self._command(cmd, opt)
+        if command:
+            self.writecooked(command)
 
     def read_sb_data(self):
         """Return any data available in the SB ... SE queue.
@@ -675,6 +789,12 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
         self._current_line = ''
         
         while True:
+            if not line:
+                run = self.getline_ready()
+                if run:
+                    'Fast path for a complete line already waiting (e.g. pasted by a bot)'
+                    self._readline_echo(run, echo)
+                    return self._readline_result(run[:-1], echo, prompt, use_history)
             c = self.getc(block=True)
             c = self.ansi_to_curses(c)
             if c == theNULL:
@@ -730,16 +850,7 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
                 return 'QUIT'
             elif c == chr(10):
                 self._readline_echo(c, echo)
-                result = ''.join(line)
-                if use_history:
-                    self.history.append(result)
-                if echo is False:
-                    if prompt:
-                        self.write( chr(10) )
-                    log.debug('readline: %s(hidden text)', prompt)
-                else:
-                    log.debug('readline: %s%r', prompt, result)
-                return result
+                return self._readline_result(''.join(line), echo, prompt, use_history)
             elif c == curses.KEY_BACKSPACE or c == chr(127) or c == chr(8):
                 if insptr > 0:
                     self._readline_echo(self.CODES['CSRLEFT'] + self.CODES['DEL'], echo)
@@ -767,10 +878,29 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
             if self._readline_do_echo(echo):
                 self._current_line = line
     
+    def _readline_result(self, result, echo, prompt, use_history):
+        """Finish a line read by readline"""
+        if use_history:
+            self.history.append(result)
+        if echo is False:
+            if prompt:
+                self.write( chr(10) )
+            log.debug('readline: %s(hidden text)', prompt)
+        else:
+            log.debug('readline: %s%r', prompt, result)
+        return result
+
+    def getline_ready(self):
+        """Return a complete line of plain characters (including the
+        terminating LF) if one is already waiting in the input queue,
+        '' otherwise. Never blocks."""
+        return ''
+
     #abstractmethod
-    def getc(self, block=True):
-        """Return one character from the input queue"""
+    def getc(self, block=True, timeout=None):
+        """Return one character from the input queue ('' if nothing arrived within timeout)"""
         # This is very different between green threads and real threads.
+        # Note: should flush() the output before blocking
         raise NotImplementedError("Please Implement the getc method")
 
 # --------------------------- Output Functions -----------------------------
@@ -793,6 +923,7 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
         log.debug('writing message %r', text)
         self.write(chr(10)+text+chr(10))
         self.write(self._current_prompt+''.join(self._current_line))
+        self.flush()
 
     def write(self, text):
         """Send a packet to the socket. This function cooks output."""
@@ -803,7 +934,22 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
 
     def writecooked(self, text):
         """Put data directly into the output queue (bypass output cooker)"""
-        self.sock.sendall(text)
+        self.outbuf.append(text)
+        self.outbuf_len += len(text)
+        if self.outbuf_len >= self.OUTBUF_SIZE:
+            self._flush_outbuf()
+
+    def flush(self):
+        """Send out the buffered output (e.g. before blocking for input)"""
+        self._flush_outbuf()
+
+    def _flush_outbuf(self):
+        """Send the output queue to the socket in one go"""
+        if self.outbuf:
+            text = ''.join(self.outbuf)
+            self.outbuf = []
+            self.outbuf_len = 0
+            self.sock.sendall(text)
 
 # ------------------------------- Input Cooker -----------------------------
     def _inputcooker_getc(self, block=True):
@@ -814,15 +960,44 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
             ret = self.rawq[0]
             self.rawq = self.rawq[1:]
             return ret
+        if self.rawpos < self.rawlen:
+            ret = chr(self.rawbuf[self.rawpos])
+            self.rawpos += 1
+            return ret
         if not block:
             if not self.inputcooker_socket_ready():
                 return ''
-        ret = self.sock.recv(20)
+        self._inputcooker_recv()
+        return self._inputcooker_getc(block)
+
+    def _inputcooker_recv(self):
+        """Refill the (empty) raw buffer from the socket. Raise EOFError on
+        end of stream. SHOULD ONLY BE CALLED FROM THE INPUT COOKER."""
+        if self.outbuf:
+            # e.g. answers to options - don't hold them while waiting for input
+            self.flush()
+        ret = self.sock.recv_into(self.rawview)
         self.eof = not(ret)
-        self.rawq = self.rawq + ret
         if self.eof:
             raise EOFError
-        return self._inputcooker_getc(block)
+        self.rawpos = 0
+        self.rawlen = ret
+
+    def _inputcooker_getrun(self):
+        """Get a run of plain characters (up to the next IAC, CR or key
+        sequence) from the raw buffer in one go. Block until data is
+        available and return '' if the next character needs cooking.
+        SHOULD ONLY BE CALLED FROM THE INPUT COOKER."""
+        if self.rawq:
+            return ''
+        if self.rawpos >= self.rawlen:
+            self._inputcooker_recv()
+        match = self.PLAINRE.match(self.rawbuf, self.rawpos, self.rawlen)
+        if not match:
+            return ''
+        ret = self.rawview[self.rawpos:match.end()].tobytes()
+        self.rawpos = match.end()
+        return ret
 
     #abstractmethod
     def inputcooker_socket_ready(self):
@@ -834,7 +1009,12 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
     def _inputcooker_ungetc(self, char):
         """Put characters back onto the head of the rawq. SHOULD ONLY
         BE CALLED FROM THE INPUT COOKER."""
-        self.rawq = char + self.rawq
+        # Usually the characters have just been read from the raw buffer
+        # so it's enough to rewind the read offset
+        if not self.rawq and len(char) <= self.rawpos and self.rawbuf[self.rawpos - len(char):self.rawpos] == char:
+            self.rawpos -= len(char)
+        else:
+            self.rawq = char + self.rawq
 
     def _inputcooker_store(self, char):
         """Put the cooked data in the correct queue"""
@@ -856,6 +1036,11 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
         """
         try:
             while True:
+                if not self.iacseq:
+                    run = self._inputcooker_getrun()
+                    if run:
+                        self._inputcooker_store(run)
+                        continue
                 c = self._inputcooker_getc()
                 if not self.iacseq:
                     if c == IAC:
@@ -870,21 +1055,20 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
                         else:
                             self._inputcooker_ungetc(c2)
                             c = chr(10)
-                    elif c in [x[0] for x in self.ESCSEQ.keys()]:
+                    elif c in self.ESCTRIE:
                         'Looks like the begining of a key sequence'
-                        codes = c
-                        for keyseq in self.ESCSEQ.keys():
-                            if len(keyseq) == 0:
-                                continue
-                            while codes == keyseq[:len(codes)] and len(codes) <= keyseq:
-                                if codes == keyseq:
-                                    c = self.ESCSEQ[keyseq]
-                                    break
-                                codes = codes + self._inputcooker_getc()
-                            if codes == keyseq:
+                        node = self.ESCTRIE[c]
+                        codes = ''
+                        while None not in node:
+                            c2 = self._inputcooker_getc()
+                            codes += c2
+                            if c2 not in node:
+                                # Not a key sequence after all
+                                self._inputcooker_ungetc(codes)
                                 break
-                            self._inputcooker_ungetc(codes[1:])
-                            codes = codes[0]
+                            node = node[c2]
+                        else:
+                            c = node[None]
                     self._inputcooker_store(c)
                 elif len(self.iacseq) == 1:
                     'IAC: IAC CMD [OPTION only for WILL/WONT/DO/DONT]'
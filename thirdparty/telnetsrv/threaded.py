@@ -1,6 +1,7 @@
 #!/usr/bin/python
 # Telnet handler concrete class using true threads.
 
+import collections
 import threading
 import time
 import select
@@ -10,12 +11,16 @@ from telnetsrvlib import TelnetHandlerBase, command
 class TelnetHandler(TelnetHandlerBase):
     "A telnet server handler using Threading"
     def __init__(self, request, client_address, server):
-        # This is the cooked input stream (list of charcodes)
-        self.cookedq = []   
+        # This is the cooked input stream (deque of charcodes)
+        self.cookedq = collections.deque()
 
         # Create the locks for handing the input/output queues
         self.IQUEUELOCK = threading.Lock()
         self.OQUEUELOCK = threading.Lock()
+        # Signalled when cooked data (or EOF) arrives in the input queue
+        self.IQUEUECOND = threading.Condition(self.IQUEUELOCK)
+        # Set once the client has answered the initial options
+        self.negotiated = threading.Event()
 
         # Call the base class init method
         TelnetHandlerBase.__init__(self, request, client_address, server)
@@ -29,9 +34,12 @@ class TelnetHandler(TelnetHandlerBase):
         self.thread_ic.start()
         # Note that inputcooker exits on EOF
         
-        # Sleep for 0.5 second to allow options negotiation
-        time.sleep(0.5)
-        
+        # Wait (at most NEGOTIATION_TIMEOUT) for the options negotiation
+        self.negotiated.wait(self.NEGOTIATION_TIMEOUT)
+
+    def negotiation_done(self):
+        '''Called once the client has answered all initial options'''
+        self.negotiated.set()
 
     def finish(self):
         '''Called as the session is ending'''
@@ -41,32 +49,75 @@ class TelnetHandler(TelnetHandlerBase):
 
     # -- Threaded input handling functions --
 
-    def getc(self, block=True):
-        """Return one character from the input queue"""
-        if not block:
-            if not len(self.cookedq):
-                return ''
-        while not len(self.cookedq):
-            time.sleep(0.05)
-        self.IQUEUELOCK.acquire()
-        ret = self.cookedq[0]
-        self.cookedq = self.cookedq[1:]
-        self.IQUEUELOCK.release()
-        return ret
+    def getc(self, block=True, timeout=None):
+        """Return one character from the input queue.
+        Return '' if nothing arrived within timeout (or at once if not block).
+        Raise EOFError once the input cooker has finished and the queue is empty."""
+        if block and not self.cookedq:
+            # About to wait for the client - send out everything it should see first
+            self.flush()
+        self.IQUEUECOND.acquire()
+        try:
+            if block:
+                if timeout is not None:
+                    deadline = time.time() + timeout
+                while not self.cookedq and not self.eof:
+                    if timeout is None:
+                        self.IQUEUECOND.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self.IQUEUECOND.wait(remaining)
+            if self.cookedq:
+                return self.cookedq.popleft()
+            if self.eof:
+                raise EOFError
+            return ''
+        finally:
+            self.IQUEUECOND.release()
+
+    def getline_ready(self):
+        """Return a complete line of plain characters (including the LF)
+        if one is already waiting in the input queue, '' otherwise"""
+        self.IQUEUECOND.acquire()
+        try:
+            for i, c in enumerate(self.cookedq):
+                if c == chr(10):
+                    return ''.join([self.cookedq.popleft() for _ in xrange(i + 1)])
+                if type(c) is not str or c < ' ' or c == chr(127):
+                    # Needs the line editor (control character or key code)
+                    break
+            return ''
+        finally:
+            self.IQUEUECOND.release()
+
+    def inputcooker(self):
+        """Input cooker thread - wake up any waiting reader once it exits"""
+        try:
+            TelnetHandlerBase.inputcooker(self)
+        finally:
+            self.IQUEUECOND.acquire()
+            self.eof = 1
+            self.IQUEUECOND.notifyAll()
+            self.IQUEUECOND.release()
 
     def inputcooker_socket_ready(self):
         """Indicate that the socket is ready to be read"""
-        return select.select([self.sock.fileno()], [], [], 0) != ([], [], [])
+        # Note: poll() as select() can't handle descriptors >= FD_SETSIZE (1024)
+        poller = select.poll()
+        poller.register(self.sock.fileno(), select.POLLIN)
+        return poller.poll(0) != []
 
     def inputcooker_store_queue(self, char):
-        """Put the cooked data in the input queue (with locking)"""
-        self.IQUEUELOCK.acquire()
+        """Put the cooked data in the input queue (with locking) and wake up the reader"""
+        self.IQUEUECOND.acquire()
         if type(char) in [type(()), type([]), type("")]:
-            for v in char:
-                self.cookedq.append(v)
+            self.cookedq.extend(char)
         else:
             self.cookedq.append(char)
-        self.IQUEUELOCK.release()
+        self.IQUEUECOND.notify()
+        self.IQUEUECOND.release()
 
 
     # -- Threaded output handling functions --
@@ -84,6 +135,16 @@ class TelnetHandler(TelnetHandlerBase):
         """Put data directly into the output queue"""
         # Ensure this is the only thread writing
         self.OQUEUELOCK.acquire()
-        TelnetHandlerBase.writecooked(self, text)
-        self.OQUEUELOCK.release()
+        try:
+            TelnetHandlerBase.writecooked(self, text)
+        finally:
+            self.OQUEUELOCK.release()
+
+    def flush(self):
+        """Send out the buffered output"""
+        self.OQUEUELOCK.acquire()
+        try:
+            TelnetHandlerBase.flush(self)
+        finally:
+            self.OQUEUELOCK.release()
 